@@ -1,3 +1,7 @@
+from functools import lru_cache
+
+import numpy as np
+
 # grey levels
 black=(0,0,0)
 darkest_grey=(31,31,31)
@@ -218,3 +222,63 @@ silver=(203,203,203)
 # miscellaneous
 celadon=(172,255,175)
 peach=(255,159,127)
+
+# tiles
+dark_wall=(0,0,100)
+dark_ground=(50,50,150)
+light_wall=(130,110,50)
+light_ground=(200,180,50)
+
+# Visible tiles come in this many shades, fading from the dark colour to the
+# light one as more light falls on them
+light_steps = 6
+
+
+def pack(rgb):
+    """Packs rgb values, or an array of them, into 0xRRGGBB ints"""
+    rgb = np.asarray(rgb, dtype=np.int32)
+    return rgb[..., 0] << 16 | rgb[..., 1] << 8 | rgb[..., 2]
+
+
+@lru_cache(maxsize=None)
+def gradient(start, end, steps):
+    """Returns a lookup table of `steps` packed colours fading from start to
+    end, both included. Tables are built once per set of arguments."""
+    t = np.linspace(0, 1, steps)[:, np.newaxis]
+    rgb = np.rint(np.multiply(start, 1 - t) + np.multiply(end, t))
+    return tuple(pack(rgb).tolist())
+
+
+def shades(dark, light, steps):
+    """Returns `steps` rgb tuples from a step above `dark` up to `light`"""
+    t = np.arange(1, steps + 1)[:, np.newaxis] / steps
+    rgb = np.rint(np.multiply(dark, 1 - t) + np.multiply(light, t))
+    return [tuple(row) for row in rgb.astype(int).tolist()]
+
+
+# # palette
+# Every colour above as one row of `palette`, so a renderer can store a small
+# int per cell and expand them all with one lookup. Rows follow the order of
+# this file, so add new colours after the last one to keep indices stable.
+# The shades of lit tiles come after all of them.
+palette_names = [name for name, value in list(globals().items())
+                 if isinstance(value, tuple) and not name.startswith('_')]
+palette_rgb = [globals()[name] for name in palette_names]
+for kind in ('ground', 'wall'):
+    palette_names += [f'lit_{kind}_{step}' for step in range(light_steps)]
+    palette_rgb += shades(globals()['dark_' + kind],
+                          globals()['light_' + kind], light_steps)
+palette_index = {name: i for i, name in enumerate(palette_names)}
+palette = np.array(palette_rgb, dtype=np.uint8)
+packed_palette = pack(palette)
+index_dtype = np.uint8 if len(palette) <= 256 else np.uint16
+
+# Palette indices of the backgrounds of tiles out of sight, by tile state:
+#   state = explored * (1 + wall)
+tile_states = np.array([palette_index[name] for name in (
+    'black', 'dark_ground', 'dark_wall')], dtype=index_dtype)
+
+# Palette indices of visible tiles, indexed [wall, light level]
+lit_tiles = np.array([[palette_index[f'lit_{kind}_{step}']
+                       for step in range(light_steps)]
+                      for kind in ('ground', 'wall')], dtype=index_dtype)
@@ -2,12 +2,31 @@
 # -*- coding: utf-8 -*-
 
 
+import argparse
+from collections import Counter, deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import io
+import itertools
+import json
 import math
+import os
+import pickle
+import heapq
 from random import randint
+import select
+import socket
+import socketserver
 import sys
+import tempfile
 import textwrap
+import threading
+import time
+import zlib
 
 import numpy as np
+import tcod.constants
+import tcod.map
 import tcod.path
 import tdl
 
@@ -33,11 +52,12 @@ class Entity:
     ai -(object)- object which holds ai instructions
     item -(object)- object which holds item instructions
     equipment -(object)- object which holds equipment instructions
+    light -(int)- how far the light the entity gives off reaches, 0 for none
     """
 
     def __init__(self, x, y, char, name, color, blocks=False,
                  always_visible=False, fighter=None, ai=None, item=None,
-                 equipment=None):
+                 equipment=None, light=0):
         self.x = x
         self.y = y
         self.char = char
@@ -45,6 +65,9 @@ class Entity:
         self.name = name
         self.blocks = blocks
         self.always_visible = always_visible
+        self.light = light
+        # The Field counting this entity in its occupants, see Field.occupy
+        self.occupying = None
 
         self.fighter = fighter
         if self.fighter:
@@ -61,62 +84,52 @@ class Entity:
             self.item = Item(use_func=self.equipment.toggle_equip)
             self.item.owner = self
 
-    def clear(self):
-        con.draw_char(self.x, self.y, ' ', self.color)
-
     def distance_to(self, other):
         dx = other.x - self.x
         dy = other.y - self.y
         return math.sqrt(dx ** 2 + dy ** 2)
 
-    def draw(self):
+    def shown(self):
         # Display this entity if it is in the player's FOV
         # Some entities are 'always visible' after they've been found
-        if (self.x, self.y) in visible_tiles or \
-                (self.always_visible and field[self.x][self.y].explored):
-            con.draw_char(self.x, self.y, self.char, self.color)
+        return (self.x, self.y) in game.visible_tiles or \
+            (self.always_visible and game.field.explored[self.x, self.y])
+
+    def place(self, x, y):
+        # Blocking entities on the floor move through here, so the floor's
+        # occupants stay right
+        fld = self.occupying
+        if fld is not None:
+            fld.occupants[self.x, self.y] -= 1
+            fld.occupants[x, y] += 1
+        self.x, self.y = x, y
 
     def move(self, dx, dy):
         # If the desired tile is blocked, do not move
         if not is_blocked(self.x + dx, self.y + dy):
-            self.x += dx
-            self.y += dy
-
-    def move_towards(self, target_x, target_y):
-        # This movement will not easily go around corners
-        dx = target_x - self.x
-        dy = target_y - self.y
-        distance = math.sqrt(dx ** 2 + dy ** 2)
-        dx = int(round(dx / distance))
-        dy = int(round(dy / distance))
-        self.move(dx, dy)
-
-    def move_astar(self, target_x, target_y):
-        path = astar.get_path(self.x, self.y, target_x, target_y)
-        dx, dy = path[0][0] - self.x, path[0][1] - self.y
-        self.move(dx, dy)
+            self.place(self.x + dx, self.y + dy)
 
     def send_to_back(self):
-        global objects
-        objects.remove(self)
-        objects.insert(0, self)
-
-    def closest_monster(self, max_range):
-        closest_enemy = None
-        closest_dist = max_range + 1
-        for obj in objects:
-            if obj.fighter \
-                    and obj != player \
-                    and obj != self \
-                    and (obj.x, obj.y) in visible_tiles:
-                if (self.name == 'Your ally' or self == player) \
-                        and obj.name == 'Your ally':
-                    continue
-                dist = player.distance_to(obj)
-                if dist < closest_dist:
-                    closest_enemy = obj
-                    closest_dist = dist
-        return closest_enemy
+        game.objects.remove(self)
+        game.objects.insert(0, self)
+
+
+def hud_stat(name, widget):
+    """A Fighter attribute which marks the HUD `widget` showing it dirty
+    through the Fighter's observer whenever it changes"""
+
+    attr = '_' + name
+
+    def get(self):
+        return getattr(self, attr)
+
+    def set(self, value):
+        if self.observer is not None and \
+                value != getattr(self, attr, value):
+            self.observer(widget)
+        setattr(self, attr, value)
+
+    return property(get, set)
 
 
 class Fighter:
@@ -129,6 +142,12 @@ class Fighter:
     xp -(int)- the amount of experience the entity has
         xp is yielded to the entity's murderer upon death
     death_func -(function)- in the event of death, call
+    speed -(int)- how often the entity acts, 100 being once per player turn
+
+    Attributes:
+    observer -(function)- called with the name of the HUD widget showing a
+        stat when that stat changes, None when the stats are not shown
+    stunned -(int)- how many of its coming turns the entity loses
 
     Functions:
     attack(<target>) - attempts to deal damage to <target> Entity
@@ -139,9 +158,20 @@ class Fighter:
 
     # TODO: Magic Defense
 
+    hp = hud_stat('hp', 'hp')
+    base_max_hp = hud_stat('base_max_hp', 'hp')
+    mp = hud_stat('mp', 'mp')
+    base_max_mp = hud_stat('base_max_mp', 'mp')
+    base_power = hud_stat('base_power', 'str')
+    base_mag = hud_stat('base_mag', 'mag')
+    base_defense = hud_stat('base_defense', 'def')
+    base_regen = hud_stat('base_regen', 'reg')
+    xp = hud_stat('xp', 'xp')
+
     def __init__(self, hp, defense, power, xp,
                  mp=0, mag=0, regen=0,
-                 death_func=None):
+                 death_func=None, speed=100):
+        self.observer = None
         self.base_max_hp = hp
         self.base_max_mp = mp
         self.base_defense = defense
@@ -153,6 +183,8 @@ class Fighter:
         self.mp = mp
         self.xp = xp
         self.death_func = death_func
+        self.speed = speed
+        self.stunned = 0
 
     @property
     def max_hp(self):
@@ -187,7 +219,7 @@ class Fighter:
     def attack(self, target):
         damage = self.power - target.fighter.defense
 
-        if self.owner == player:
+        if self.owner == game.player:
             msg_color = colors.light_blue
         elif self.owner.name == 'Your ally':
             msg_color = colors.gold
@@ -197,9 +229,11 @@ class Fighter:
         if damage < 1:
             damage = 1
 
-        message(f"{self.owner.name} attacks {target.name} for {damage}",
-                msg_color)
+        game.events.emit(Attack(self.owner.name, target.name, damage,
+                                msg_color))
         target.fighter.take_damage(damage)
+        # Fighting is loud
+        game.scheduler.wake_near(self.owner.x, self.owner.y, noise_radius)
 
     def heal(self, health, mana=0):
         self.hp += health
@@ -211,12 +245,13 @@ class Fighter:
             self.mp = self.max_mp
 
     def take_damage(self, damage):
+        game.events.emit(Damage(self.owner.name, damage))
         self.hp -= damage
 
         if self.hp <= 0:
             # TODO: xp goes to the killer even if it's a monster?
-            if self.owner != player:
-                player.fighter.xp += self.xp
+            if self.owner != game.player:
+                game.player.fighter.xp += self.xp
 
             death = self.death_func
             if death is not None:
@@ -236,40 +271,35 @@ class Item:
         self.kwargs = kwargs
 
     def drop(self):
-        objects.append(self.owner)
+        game.objects.append(self.owner)
         if self.owner.equipment:
             self.owner.equipment.unequip()
-            equipment.remove(self.owner)
+            game.equipment.remove(self.owner)
         else:
-            inventory.remove(self.owner)
-        self.owner.x = player.x
-        self.owner.y = player.y
+            game.inventory.remove(self.owner)
+        self.owner.x = game.player.x
+        self.owner.y = game.player.y
         message(f'You place the {self.owner.name} on the ground', colors.yellow)
 
     def pick_up(self):
         # If it's equipment, put it in your equipment menu
         if self.owner.equipment:
-            if len(equipment) >= 26:
-                message(
-                    f'Your pack is full, couldn\'t pick up {self.owner.name}',
-                    colors.red)
+            if len(game.equipment) >= 26:
+                game.events.emit(Pickup(self.owner.name, 'pack', False))
                 return
             else:
-                equipment.append(self.owner)
-                objects.remove(self.owner)
-                message(f'You put the {self.owner.name} in your pack.',
-                        colors.light_green)
+                game.equipment.append(self.owner)
+                game.objects.remove(self.owner)
+                game.events.emit(Pickup(self.owner.name, 'pack', True))
             return
 
         # Add to inventory
-        if len(inventory) >= 26:
-            message(f'Pockets are full, couldn\'t pick up {self.owner.name}',
-                    colors.red)
+        if len(game.inventory) >= 26:
+            game.events.emit(Pickup(self.owner.name, 'pocket', False))
         else:
-            inventory.append(self.owner)
-            objects.remove(self.owner)
-            message(f'You put a {self.owner.name} in your pocket.',
-                    colors.light_green)
+            game.inventory.append(self.owner)
+            game.objects.remove(self.owner)
+            game.events.emit(Pickup(self.owner.name, 'pocket', True))
 
     def use(self):
         # If this is equipment, toggle equip
@@ -284,7 +314,7 @@ class Item:
             # This calls use_func and checks the return
             if self.use_func(**self.kwargs) != 'cancel':
                 # Remove the item from inventory unless it shouldn't be removed
-                inventory.remove(self.owner)
+                game.inventory.remove(self.owner)
 
 
 class Equipment:
@@ -316,17 +346,26 @@ class Equipment:
             old_equipment.unequip()
 
         self.is_equipped = True
-        message(f'{self.owner.name} equipped to {self.slot}')
+        game.hud.mark(*self.widgets())
+        game.events.emit(Equip(self.owner.name, self.slot, True))
 
     def unequip(self):
         if not self.is_equipped:
             return
         self.is_equipped = False
-        message(f'{self.owner.name} unequipped from {self.slot}')
+        game.hud.mark(*self.widgets())
+        game.events.emit(Equip(self.owner.name, self.slot, False))
+
+    def widgets(self):
+        # The HUD widgets showing the stats this item changes
+        bonuses = {'hp': self.max_hp, 'mp': self.max_mp, 'str': self.power,
+                   'def': self.defense, 'mag': self.magick,
+                   'reg': self.regen}
+        return [widget for widget, bonus in bonuses.items() if bonus]
 
 
 def get_equipped_in_slot(slot):
-    for item in equipment:
+    for item in game.equipment:
         if item.equipment.slot == slot and item.equipment.is_equipped:
             return item.equipment
     return None
@@ -334,7 +373,7 @@ def get_equipped_in_slot(slot):
 
 def get_all_equipped():
     equipped = []
-    for equip in equipment:
+    for equip in game.equipment:
         if equip.equipment.is_equipped:
             equipped.append(equip.equipment)
     return equipped
@@ -356,23 +395,25 @@ class BasicMonster:
     and attack.
     Basic monster will attack any allies or the player based on who has the most
     HP remaining.
+    Plans 'dormant' when out of sight, see Scheduler.
     """
 
-    def take_turn(self):
+    def plan(self, view):
         monster = self.owner
 
-        if (monster.x, monster.y) in visible_tiles:
-            target = player
-            if self.owner.closest_monster(4) is not None:
-                other = self.owner.closest_monster(4)
-                if (other.name == 'Your ally'
-                        and other.fighter.hp >= player.fighter.hp):
-                    target = other
-
-            if monster.distance_to(target) >= 2:
-                monster.move_towards(target.x, target.y)
-            elif player.fighter.hp > 0:
-                monster.fighter.attack(target)
+        if view.visible[view.where[monster]]:
+            target = view.player
+            other = view.closest_monster(monster, 4)
+            if other is not None and view.names[other] == 'Your ally' \
+                    and view.hp[other] >= view.hp[view.player]:
+                target = other
+
+            if view.distance(monster, target) >= 2:
+                return view.step_towards(monster, target)
+            elif view.hp[view.player] > 0:
+                return 'attack', target
+        else:
+            return 'dormant'
 
 
 class Behemoth:
@@ -381,51 +422,57 @@ class Behemoth:
     If the player comes within a few tiles of the creature, it will follow
     and attack the player. Otherwise it will remain still.
     Behemoths pay no heed to allies.
+    Plans 'dormant' when out of sight, see Scheduler.
     """
 
+    # Behemoth has a 3 starburst danger zone, stored as a stencil indexed
+    # [dx + 3, dy + 3]
+    #                                (0, -3),
+    #            (-2, -2), (-1, -2), (0, -2), (+1, -2), (+2, -2),
+    #            (-2, -1), (-1, -1), (0, -1), (+1, -1), (+2, -1),
+    #  (-3,  0), (-2,  0), (-1,  0),          (+1,  0), (+2,  0), (+3,  0),
+    #            (-2, +1), (-1, +1), (0, +1), (+1, +1), (+2, +1),
+    #            (-2, +2), (-1, +2), (0, +2), (+1, +2), (+2, +2),
+    #                                (0, +3)
+    aura_radius = 3
+    aura = np.zeros((7, 7), dtype=bool)
+    aura[1:6, 1:6] = True
+    aura[3, 3] = False
+    aura[[0, 6, 3, 3], [3, 3, 0, 6]] = True
+
     def __init__(self):
-        # Behemoth has a 3 starburst danger zone
-        #                                (0, -3),
-        #            (-2, -2), (-1, -2), (0, -2), (+1, -2), (+2, -2),
-        #            (-2, -1), (-1, -1), (0, -1), (+1, -1), (+2, -1),
-        #  (-3,  0), (-2,  0), (-1,  0),          (+1,  0), (+2,  0), (+3,  0),
-        #            (-2, +1), (-1, +1), (0, +1), (+1, +1), (+2, +1),
-        #            (-2, +2), (-1, +2), (0, +2), (+1, +2), (+2, +2),
-        #                                (0, +3)
-        self.aura = [
-            (0, -3),
-            (-2, -2), (-1, -2), (0, -2), (+1, -2), (+2, -2),
-            (-2, -1), (-1, -1), (0, -1), (+1, -1), (+2, -1),
-            (-3, 0), (-2, 0), (-1, 0), (+1, 0), (+2, 0), (+3, 0),
-            (-2, +1), (-1, +1), (0, +1), (+1, +1), (+2, +1),
-            (-2, +2), (-1, +2), (0, +2), (+1, +2), (+2, +2),
-            (0, +3)
-        ]
+        self.zone_at = None
+        self.zone = None
 
     def danger_zone(self):
-        if (self.owner.x, self.owner.y) in visible_tiles:
-
-            con.draw_char(self.owner.x, self.owner.y,
-                          self.owner.char, self.owner.color)
-
-            for tx, ty in self.aura:
-                if not is_blocked(self.owner.x + tx, self.owner.y + ty) and \
-                        field[self.owner.x + tx][self.owner.y + ty].explored:
-                    con.draw_char(self.owner.x + tx, self.owner.y + ty, None,
-                                  fg=None, bg=colors.light_flame)
-
-    def take_turn(self):
-        self.owner.draw = self.danger_zone
+        """Returns the window of the field around this behemoth and the mask
+        of walkable tiles its aura covers inside that window
+        The mask is only rebuilt after the behemoth moves
+        """
 
+        x, y = self.owner.x, self.owner.y
+        if self.zone_at != (x, y):
+            r = self.aura_radius
+            x1, x2 = max(x - r, 0), min(x + r + 1, game.field.width)
+            y1, y2 = max(y - r, 0), min(y + r + 1, game.field.height)
+            window = slice(x1, x2), slice(y1, y2)
+            stencil = self.aura[x1 - x + r:x2 - x + r, y1 - y + r:y2 - y + r]
+            self.zone = window, stencil & ~game.field.blocked[window]
+            self.zone_at = x, y
+        return self.zone
+
+    def plan(self, view):
         monster = self.owner
-        if (monster.x, monster.y) in visible_tiles:
+        if view.visible[view.where[monster]]:
 
-            if monster.distance_to(player) > 3:
+            if view.distance(monster, view.player) > 3:
                 pass
-            elif monster.distance_to(player) >= 2:
-                monster.move_astar(player.x, player.y)
-            elif player.fighter.hp > 0:
-                monster.fighter.attack(player)
+            elif view.distance(monster, view.player) >= 2:
+                return view.path_step(monster, view.player)
+            elif view.hp[view.player] > 0:
+                return 'attack', view.player
+        else:
+            return 'dormant'
 
 
 # TODO: Allies should maybe be in a special list?
@@ -440,17 +487,278 @@ class Ally:
     Ally stats are boosted 25% above normal
     """
 
-    def take_turn(self):
+    def plan(self, view):
         ally = self.owner
-        enemy = self.owner.closest_monster(5)
+        # Every ally picks the same enemy, the one closest to the player
+        enemy = view.closest_monster(ally, 5)
         if enemy is not None:
-            if ally.distance_to(enemy) >= 2:
-                ally.move_astar(enemy.x, enemy.y)
+            if view.distance(ally, enemy) >= 2:
+                return view.flow_step(ally, enemy)
             else:
-                ally.fighter.attack(enemy)
+                return 'attack', enemy
+        else:
+            if view.distance(ally, view.player) >= 2:
+                return view.flow_step(ally, view.player)
+
+
+class WorldView:
+    """What the AI may know of the floor, frozen when a tick's actors start
+    planning. plan() methods read only this, never the live entities, so
+    they can run on the planning pool in any order and come out the same.
+    Spells take a fresh one to look for targets.
+
+    Plans are ('move', dx, dy), ('attack', <target>), 'dormant' or None for
+    doing nothing, and are carried out by carry_out().
+
+    Attributes:
+    visible -(ndarray)- the tiles the player can see, indexed [x, y]
+    player -(Entity)- the player
+    fighters -(list)- every living fighter, in the order of game.objects
+    where, names, hp, factions -(dict)- each fighter's tile, name, hp and
+        faction()
+    x, y, faction -(ndarray)- the same in the order of fighters, for near()
+    paths -(PathGraph)- the floor's pathfinder
+    """
+
+    def __init__(self):
+        self.visible = game.visible
+        self.player = game.player
+        self.paths = game.field.path_graph()
+        self.fighters = [obj for obj in game.objects if obj.fighter]
+        self.index = {obj: i for i, obj in enumerate(self.fighters)}
+        self.where = {obj: (obj.x, obj.y) for obj in self.fighters}
+        self.names = {obj: obj.name for obj in self.fighters}
+        self.hp = {obj: obj.fighter.hp for obj in self.fighters}
+        self.factions = {obj: faction(obj) for obj in self.fighters}
+
+        self.x = np.array([obj.x for obj in self.fighters], dtype=np.intp)
+        self.y = np.array([obj.y for obj in self.fighters], dtype=np.intp)
+        self.faction = np.array(list(self.factions.values()), dtype='U7')
+        # What closest_monster() found, by the factions and range it asked
+        self.nearest = {}
+
+    def distance(self, ent, other):
+        (x, y), (ox, oy) = self.where[ent], self.where[other]
+        return math.sqrt((ox - x) ** 2 + (oy - y) ** 2)
+
+    def near(self, x, y, radius=None, factions=None, sight=None,
+             exclude=()):
+        """Returns the fighters closer than `radius` to (x, y), nearest
+        first, found in one pass over the position arrays
+        Fighters the same distance away keep their order in game.objects
+
+        Keyword Arguments:
+        radius -(float)- None for any distance
+        factions -(collection)- only fighters of these factions
+        sight -(ndarray)- only fighters on tiles True in this bool array
+            indexed [x, y], such as visible or one from sight_from()
+        exclude -(collection)- fighters to leave out
+        """
+
+        d2 = (self.x - x) ** 2 + (self.y - y) ** 2
+        keep = np.ones(len(self.fighters), dtype=bool)
+        if radius is not None:
+            keep &= d2 < radius ** 2
+        if factions is not None:
+            keep &= np.isin(self.faction, list(factions))
+        if sight is not None:
+            keep &= sight[self.x, self.y]
+        for ent in exclude:
+            if ent in self.index:
+                keep[self.index[ent]] = False
+
+        found = np.flatnonzero(keep)
+        found = found[np.argsort(d2[found], kind='stable')]
+        return [self.fighters[i] for i in found]
+
+    def closest_monster(self, ent, max_range):
+        """Returns the nearest fighter the player can see which `ent` would
+        fight, or None if there is none within `max_range`
+        Monsters fight allies as well, and the range is measured from the
+        player whoever is asking
+        """
+
+        if self.factions[ent] == 'monster':
+            enemies = ('monster', 'ally')
+        else:
+            enemies = ('monster',)
+        # Measured from the player, so everyone asking shares one search
+        found = self.nearest.get((enemies, max_range))
+        if found is None:
+            found = self.near(*self.where[self.player], max_range + 1,
+                              enemies, self.visible)
+            self.nearest[enemies, max_range] = found
+        for other in found:
+            if other is not ent:
+                return other
+        return None
+
+    def step_towards(self, ent, target):
+        # This movement will not easily go around corners
+        (x, y), (tx, ty) = self.where[ent], self.where[target]
+        distance = math.sqrt((tx - x) ** 2 + (ty - y) ** 2)
+        return ('move', int(round((tx - x) / distance)),
+                int(round((ty - y) / distance)))
+
+    def path_step(self, ent, target):
+        (x, y), (tx, ty) = self.where[ent], self.where[target]
+        step = self.paths.first_step(x, y, tx, ty)
+        if step is not None:
+            return ('move',) + step
+
+    def flow_step(self, ent, target):
+        """Like path_step(), for targets many entities head for at once:
+        they share one PathGraph.flow() instead of each searching"""
+
+        (x, y), (tx, ty) = self.where[ent], self.where[target]
+        dist = self.paths.flow(tx, ty)
+        steps = [(dist[x + dx, y + dy], dx, dy)
+                 for dx, dy in ((0, -1), (0, 1), (-1, 0), (1, 0))
+                 if dist[x + dx, y + dy] >= 0]
+        if steps:
+            return ('move',) + min(steps)[1:]
+
+
+def plan_turns(actors):
+    """Has each of `actors` plan its turn against the same WorldView, on the
+    planning pool when there are at least ai_parallel_min of them
+    Returns the plans in the order of `actors`
+    """
+
+    global planning_pool
+
+    view = WorldView()
+    if ai_workers < 2 or len(actors) < ai_parallel_min:
+        return [actor.ai.plan(view) for actor in actors]
+    if planning_pool is None:
+        planning_pool = ThreadPoolExecutor(ai_workers,
+                                           thread_name_prefix='ai')
+    # Thread pools ignore map()'s chunksize, so each worker is handed its
+    # share of the actors as one list
+    chunk = -(-len(actors) // ai_workers)
+    shares = [actors[i:i + chunk] for i in range(0, len(actors), chunk)]
+    plans = planning_pool.map(
+        lambda share: [actor.ai.plan(view) for actor in share], shares)
+    return [plan for share in plans for plan in share]
+
+
+def stop_planning():
+    """Shuts down the planning pool, if plan_turns() started one"""
+
+    global planning_pool
+
+    if planning_pool is not None:
+        planning_pool.shutdown()
+        planning_pool = None
+
+
+def faction(ent):
+    """Returns 'player', 'ally' or 'monster' for a fighter"""
+
+    if ent is game.player:
+        return 'player'
+    return 'ally' if ent.name == 'Your ally' else 'monster'
+
+
+def carry_out(actor, plan):
+    """Acts out `plan` on the live floor. Actors earlier in the tick may
+    have changed it since the plan was made: moves onto a tile taken since
+    are not made, and attacks on a target that died or stepped away are
+    dropped.
+    """
+
+    if plan is None or plan == 'dormant':
+        return
+    if plan[0] == 'move':
+        actor.move(plan[1], plan[2])
+    elif plan[0] == 'attack':
+        target = plan[1]
+        if target.fighter is not None and target.fighter.hp > 0 \
+                and actor.distance_to(target) < 2:
+            actor.fighter.attack(target)
+
+
+class Scheduler:
+    """Keeps the actors on a floor in a heap, ordered by the tick of their
+    next action. Items, corpses and stairs are never in it.
+
+    An actor with speed 100 acts once every action_cost ticks, one with speed
+    200 twice as often. Actors due on the same tick all plan their turns
+    against one WorldView, then act in the order they were added.
+
+    An actor whose plan is 'dormant' leaves the heap and waits, indexed by
+    its tile, until wake() or wake_near() is called on that tile. A stunned
+    one skips its turns until Fighter.stunned runs out.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.clock = 0
+        self.count = 0
+        self.dormant = {}
+
+    def add(self, actor, delay=None):
+        if delay is None:
+            delay = action_delay(actor)
+        heapq.heappush(self.heap, (self.clock + delay, self.count, actor))
+        self.count += 1
+
+    def advance(self, ticks):
+        """Lets `ticks` pass, giving each actor every turn it is due"""
+
+        end = self.clock + ticks
+        while self.heap and self.heap[0][0] <= end:
+            due = self.heap[0][0]
+            self.clock = due
+            actors = []
+            while self.heap and self.heap[0][0] == due:
+                actor = heapq.heappop(self.heap)[2]
+                # Dead actors drop out here instead of being searched for
+                if actor.ai is None:
+                    continue
+                # Stunned ones lose the turn without planning it
+                if actor.fighter.stunned:
+                    actor.fighter.stunned -= 1
+                    self.add(actor)
+                else:
+                    actors.append(actor)
+            for actor, plan in zip(actors, plan_turns(actors)):
+                # Killed by an actor earlier in the tick
+                if actor.ai is None:
+                    continue
+                carry_out(actor, plan)
+                if plan == 'dormant':
+                    self.dormant.setdefault((actor.x, actor.y),
+                                            []).append(actor)
+                else:
+                    self.add(actor)
+        self.clock = end
+
+    def wake(self, tiles):
+        """Puts the dormant actors standing on any of `tiles` back in the heap
+
+        Keyword Arguments:
+        tiles -(set)- (x, y) tuples, such as visible_tiles
+        """
+
+        if len(tiles) < len(self.dormant):
+            woken = [tile for tile in tiles if tile in self.dormant]
         else:
-            if ally.distance_to(player) >= 2:
-                ally.move_astar(player.x, player.y)
+            woken = [tile for tile in self.dormant if tile in tiles]
+
+        for tile in woken:
+            for actor in self.dormant.pop(tile):
+                if actor.ai is not None:
+                    self.add(actor)
+
+    def wake_near(self, x, y, radius):
+        self.wake({(x + dx, y + dy)
+                   for dx in range(-radius, radius + 1)
+                   for dy in range(-radius, radius + 1)})
+
+
+def action_delay(actor):
+    return action_cost * 100 // actor.fighter.speed
 
 
 # # Spells and Items # #
@@ -467,13 +775,17 @@ def enthrall():
     The nearest monster enters the service of the player
     """
 
-    target = player.closest_monster(5)
+    target = WorldView().closest_monster(game.player, 5)
     if target is None:
         return 'cancel'
 
+    game.events.emit(Spell('enthrall', target.name, 0, None))
+    make_ally(target)
+
+
+def make_ally(target):
     target.ai = Ally()
     target.ai.owner = target
-    message(f'The {target.name} is now your ally!', colors.gold)
     target.name = 'Your ally'
     target.color = colors.gold
     target.fighter.base_max_hp = int(1.15 * target.fighter.max_hp)
@@ -492,23 +804,21 @@ def healing(hp_lower, hp_upper, mp_cost):
     mp_cost -(int)- the amount of mp required to cast the spell
     """
 
-    if player.fighter.hp == player.fighter.max_hp:
+    if game.player.fighter.hp == game.player.fighter.max_hp:
         message('You don\'t need to recover any HP', colors.yellow)
         return 'cancel'
 
-    if player.fighter.mp < mp_cost:
+    if game.player.fighter.mp < mp_cost:
         message(f'Your spell fizzles. You need at least {mp_cost} MP.',
                 colors.yellow)
         return 'cancel'
 
-    player.fighter.mp -= mp_cost
+    game.player.fighter.mp -= mp_cost
 
     heal_amount = randint(hp_lower, hp_upper)
-    message(f'On a scale of 0 to {player.fighter.max_hp}, you feel...',
-            colors.light_red)
-    message(f'{heal_amount} better than you did.',
-            colors.red)
-    player.fighter.heal(heal_amount)
+    game.events.emit(Spell('healing', None, heal_amount,
+                           game.player.fighter.max_hp))
+    game.player.fighter.heal(heal_amount)
 
 
 def magic_missile(caster, damage, mp_cost):
@@ -520,21 +830,20 @@ def magic_missile(caster, damage, mp_cost):
     mp_cost -(int)- the amount of mp required to cast the spell
     """
 
-    if player.fighter.mp < mp_cost:
+    if game.player.fighter.mp < mp_cost:
         message(f'Your spell fizzles. You need at least {mp_cost} MP.',
                 colors.yellow)
         return 'cancel'
 
-    monster = caster.closest_monster(fov_radius)
+    monster = WorldView().closest_monster(caster, fov_radius)
 
     if monster is None:
         message('You can\'t cast Magic Missile at the Darkness', colors.yellow)
         return 'cancel'
 
-    player.fighter.mp -= mp_cost
-    message(f'A pale blue energy violently strikes the {monster.name}!',
-            colors.light_azure)
-    message(f'You deal {damage} points of damage!', colors.light_blue)
+    game.player.fighter.mp -= mp_cost
+    game.events.emit(Spell('magic missile', monster.name, damage, None))
+    game.flashes.append(Flash(monster.x, monster.y))
     monster.fighter.take_damage(damage)
 
 
@@ -546,13 +855,13 @@ def mana_recovery(mp_lower, mp_upper):
     mp_upper -(int)- upper limit of mp to restore
     """
 
-    if player.fighter.mp == player.fighter.max_mp:
+    if game.player.fighter.mp == game.player.fighter.max_mp:
         message("You don't need to recover any MP", colors.yellow)
         return 'cancel'
 
     rec_mp = randint(mp_lower, mp_upper)
-    player.fighter.heal(health=0, mana=rec_mp)
-    message(f'You recovered {rec_mp} MP.', colors.azure)
+    game.player.fighter.heal(health=0, mana=rec_mp)
+    game.events.emit(Spell('mana recovery', None, rec_mp, None))
 
 
 def teleport(ent, mp_cost):
@@ -563,66 +872,309 @@ def teleport(ent, mp_cost):
     mp_cost -(int)- the amount of mp required to cast the spell
     """
 
-    if player.fighter.mp < mp_cost:
+    if game.player.fighter.mp < mp_cost:
         message(f'Your spell fizzles. You need at least {mp_cost} MP.',
                 colors.yellow)
         return 'cancel'
-    else:
-        player.fighter.mp -= mp_cost
 
-    x, y = randint(0, field_width - 1), randint(0, field_height - 1)
+    tile = random_free_tile(int(game.field.labels[ent.x, ent.y]))
+    if tile is None:
+        message('There is nowhere to go!', colors.yellow)
+        return 'cancel'
+
+    game.player.fighter.mp -= mp_cost
+    ent.place(*tile)
+    if ent == game.player:
+        game.fov_recompute = True
+
+
+# # Area spells # #
+# An area spell's shape is a bool mask over the field, cut down to the tiles
+# in line of sight of the caster so walls shelter whatever is behind them.
+# The fighters caught in it are found in one pass by WorldView.near().
+
+
+def area_mask(shape, x, y, reach, aim=None):
+    """Returns the tiles an area spell cast from (x, y) covers, as a bool
+    array indexed [x, y]. The caster's own tile is never covered.
+
+    Keyword Arguments:
+    shape -(str)- 'burst' all around (x, y), or a 'cone' or 'line' pointing
+        at `aim`
+    reach -(int)- how far from (x, y) the area goes
+    aim -(tuple)- the (x, y) a cone or line points at
+    """
+
+    fld = game.field
+    x1, x2 = max(x - reach, 0), min(x + reach + 1, fld.width)
+    y1, y2 = max(y - reach, 0), min(y + reach + 1, fld.height)
+    dx, dy = np.ogrid[x1 - x:x2 - x, y1 - y:y2 - y]
+    window = dx ** 2 + dy ** 2 <= reach ** 2
+
+    if shape != 'burst':
+        # Split each tile's offset into how far it is along the aim and how
+        # far off to the side
+        ax, ay = aim[0] - x, aim[1] - y
+        norm = math.sqrt(ax ** 2 + ay ** 2)
+        along = (dx * ax + dy * ay) / norm
+        aside = np.abs(dx * ay - dy * ax) / norm
+        if shape == 'cone':
+            window &= (along > 0) & (aside <= along * cone_spread)
+        else:
+            window &= (along > 0) & (aside <= 0.5)
+
+    area = np.zeros((fld.width, fld.height), dtype=bool)
+    area[x1:x2, y1:y2] = window
+    area[x, y] = False
+    return area & sight_from(x, y, reach)[1]
+
+
+def area_spell(spell, shape, reach, damage, mp_cost, stun=0):
+    """Spell module for hurting every monster in an area
+
+    Cones and lines point at the nearest monster the player can see.
+
+    Keyword Arguments:
+    spell -(str)- the spell's name in messages
+    shape, reach -- see area_mask()
+    damage -(int)- Amount of damage to deal to each foe
+    mp_cost -(int)- the amount of mp required to cast the spell
+    stun -(int)- turns each foe left standing loses
+    """
+
+    if game.player.fighter.mp < mp_cost:
+        message(f'Your spell fizzles. You need at least {mp_cost} MP.',
+                colors.yellow)
+        return 'cancel'
 
-    while is_blocked(x, y):
-        x, y = randint(0, field_width - 1), randint(0, field_height - 1)
+    view = WorldView()
+    x, y = game.player.x, game.player.y
+    aim = None
+    if shape != 'burst':
+        target = view.closest_monster(game.player, reach)
+        if target is None:
+            message(f'There is nothing to aim the {spell} at', colors.yellow)
+            return 'cancel'
+        aim = view.where[target]
+
+    hit = view.near(x, y, factions=('monster',),
+                    sight=area_mask(shape, x, y, reach, aim))
+    if not hit:
+        message(f'The {spell} would catch nothing', colors.yellow)
+        return 'cancel'
 
-    ent.x, ent.y = x, y
-    if ent == player:
-        global fov_recompute
-        fov_recompute = True
+    game.player.fighter.mp -= mp_cost
+    game.events.emit(AreaSpell(spell, len(hit), damage, stun))
+    game.flashes.append(Flash(*(aim or (x, y))))
+    for monster in hit:
+        monster.fighter.take_damage(damage)
+        # Those it killed have no fighter left
+        if monster.fighter is not None:
+            monster.fighter.stunned = max(monster.fighter.stunned, stun)
 
 
 def player_death(the_player):
     """Displays player's corpse and a Game Over message"""
 
-    global game_state
-    message('...and You Dead.', colors.brass)
+    game.events.emit(Death(the_player.name, 'player'))
     the_player.color = colors.dark_red
     the_player.char = 'F'
     # Game over, dood.
-    game_state = 'dead'
+    game.game_state = 'dead'
 
 
 def monster_death(monster):
     """Displays the monster's corpse and a death message"""
 
-    message(f'{monster.name.capitalize()} is slain!')
+    game.events.emit(Death(monster.name, 'monster'))
     monster.name = f'what remains of {monster.name}'
     monster.char = '%'
     monster.color = colors.dark_red
     monster.send_to_back()
     # Disable the important mechanics on this entity
+    game.field.vacate(monster)
     monster.blocks = False
     monster.fighter = None
     monster.ai = None
 
 
 def behemoth_death(monster):
-    def draw():
-        if (monster.x, monster.y) in visible_tiles or \
-                (monster.always_visible and
-                 field[monster.x][monster.y].explored):
-            con.draw_char(monster.x, monster.y, monster.char, monster.color)
-    monster.draw = draw
-    message(f'The behemoth {monster.name.capitalize()} collapses.')
+    game.events.emit(Death(monster.name, 'behemoth'))
     monster.name = f'what remains of {monster.name}'
     monster.char = '%'
     monster.color = colors.dark_red
     monster.send_to_back()
+    game.field.vacate(monster)
     monster.blocks = False
     monster.fighter = None
     monster.ai = None
 
 
+# # # # # # # # # # # # # # # # # # # #
+#   Game Events
+# # # # # # # # # # # # # # # # # # # #
+# Game code emits small event records instead of building message strings.
+# Each record knows how to describe itself with lines(), which returns
+# (text, color) pairs and is only called when the message panel shows it.
+
+
+class Attack(namedtuple('Attack', ['attacker', 'target', 'damage', 'color'])):
+    __slots__ = ()
+
+    def lines(self):
+        return [(f'{self.attacker} attacks {self.target} for {self.damage}',
+                 self.color)]
+
+
+class Damage(namedtuple('Damage', ['target', 'amount'])):
+    __slots__ = ()
+
+    def lines(self):
+        # The attack or spell that did the damage already says so
+        return []
+
+
+class Death(namedtuple('Death', ['name', 'kind'])):
+    __slots__ = ()
+
+    def lines(self):
+        if self.kind == 'player':
+            return [('...and You Dead.', colors.brass)]
+        if self.kind == 'behemoth':
+            return [(f'The behemoth {self.name.capitalize()} collapses.',
+                     colors.white)]
+        return [(f'{self.name.capitalize()} is slain!', colors.white)]
+
+
+class Pickup(namedtuple('Pickup', ['item', 'container', 'ok'])):
+    __slots__ = ()
+
+    def lines(self):
+        if self.container == 'pack':
+            if self.ok:
+                return [(f'You put the {self.item} in your pack.',
+                         colors.light_green)]
+            return [(f'Your pack is full, couldn\'t pick up {self.item}',
+                     colors.red)]
+        if self.ok:
+            return [(f'You put a {self.item} in your pocket.',
+                     colors.light_green)]
+        return [(f'Pockets are full, couldn\'t pick up {self.item}',
+                 colors.red)]
+
+
+class Equip(namedtuple('Equip', ['item', 'slot', 'equipped'])):
+    __slots__ = ()
+
+    def lines(self):
+        if self.equipped:
+            return [(f'{self.item} equipped to {self.slot}', colors.white)]
+        return [(f'{self.item} unequipped from {self.slot}', colors.white)]
+
+
+class Spell(namedtuple('Spell', ['spell', 'target', 'amount', 'limit'])):
+    __slots__ = ()
+
+    def lines(self):
+        if self.spell == 'magic missile':
+            return [
+                (f'A pale blue energy violently strikes the {self.target}!',
+                 colors.light_azure),
+                (f'You deal {self.amount} points of damage!',
+                 colors.light_blue)]
+        if self.spell == 'healing':
+            return [
+                (f'On a scale of 0 to {self.limit}, you feel...',
+                 colors.light_red),
+                (f'{self.amount} better than you did.', colors.red)]
+        if self.spell == 'mana recovery':
+            return [(f'You recovered {self.amount} MP.', colors.azure)]
+        if self.spell == 'enthrall':
+            return [(f'The {self.target} is now your ally!', colors.gold)]
+        return []
+
+
+class AreaSpell(namedtuple('AreaSpell',
+                           ['spell', 'hits', 'amount', 'stun'])):
+    __slots__ = ()
+
+    def lines(self):
+        foes = 'foe' if self.hits == 1 else 'foes'
+        lines = [(f'The {self.spell} catches {self.hits} {foes}!',
+                  colors.light_azure),
+                 (f'You deal {self.amount} points of damage to each!',
+                  colors.light_blue)]
+        if self.stun:
+            turns = 'turn' if self.stun == 1 else 'turns'
+            lines.append((f'Any left standing lose {self.stun} {turns}.',
+                          colors.light_blue))
+        return lines
+
+
+class Text(namedtuple('Text', ['text', 'color'])):
+    """Anything said through message() that has no event of its own"""
+
+    __slots__ = ()
+
+    def lines(self):
+        return [(self.text, self.color)]
+
+
+class EventBus:
+    """An append-only buffer of game events
+
+    Every subscriber keeps its own place in the buffer. dispatch() hands each
+    one the events it hasn't seen yet, in order, then empties the buffer.
+    """
+
+    def __init__(self):
+        self.buffer = []
+        # [callback, index of the next event it should see]
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append([callback, len(self.buffer)])
+
+    def emit(self, event):
+        self.buffer.append(event)
+
+    def dispatch(self):
+        # A subscriber may emit while handling, go until everyone caught up
+        while any(start < len(self.buffer) for _, start in self.subscribers):
+            for sub in self.subscribers:
+                callback, start = sub
+                sub[1] = len(self.buffer)
+                for event in self.buffer[start:sub[1]]:
+                    callback(event)
+
+        del self.buffer[:]
+        for sub in self.subscribers:
+            sub[1] = 0
+
+
+def log_message(event):
+    """Message panel subscriber. The event is kept unformatted, its wrapped
+    lines are filled in the first time the panel draws it
+    """
+
+    if type(event) is not Damage:
+        game.game_msgs.append([event, None])
+        game.msg_count += 1
+
+
+def count_event(event):
+    """Telemetry subscriber tallying the events of the current turn"""
+
+    game.turn_events[type(event).__name__] += 1
+
+
+def record_replay(event):
+    """Replay subscriber writing every event as a JSON line"""
+
+    record = [type(event).__name__] + list(event)
+    game.replay_file.write(json.dumps(record) + '\n')
+
+
 # # # # # # # # # # # # # # # # # # # #
 #   Dungeon Generation
 # # # # # # # # # # # # # # # # # # # #
@@ -644,162 +1196,569 @@ class Rect:
         return (self.x1 <= other.x2 and self.x2 >= other.x1 and
                 self.y1 <= other.y2 and self.y2 >= other.y1)
 
-    def random_tile(self):
-        tilex, tiley = randint(self.x1, self.x2), randint(self.y1, self.y2)
+    def random_tile(self, fld=None):
+        """Returns a random unblocked tile inside this Rect
+        Returns None if every tile inside it is blocked
+
+        Keyword Arguments:
+        fld -(Field)- the field to check against, while it is being generated
+            When omitted, entities on the current field also block.
+        """
+
+        def blocked(x, y):
+            if fld is None:
+                return is_blocked(x, y)
+            return fld.blocked[x, y]
 
-        while is_blocked(tilex, tiley):
+        for _ in range(free_tile_tries):
             tilex, tiley = randint(self.x1, self.x2), randint(self.y1, self.y2)
+            if not blocked(tilex, tiley):
+                return tilex, tiley
 
-        return tilex, tiley
+        # Mostly blocked, so look at every open tile instead of guessing
+        terrain = (fld or game.field).blocked[self.x1:self.x2 + 1,
+                                              self.y1:self.y2 + 1]
+        for dx, dy in np.argwhere(~terrain).tolist():
+            if not blocked(self.x1 + dx, self.y1 + dy):
+                return self.x1 + dx, self.y1 + dy
+        return None
 
 
-class Tile:
-    """This represents a map tile.
+class RoomIndex:
+    """Buckets rooms into a coarse grid so overlap checks only compare a
+    candidate room against the rooms sharing its buckets.
 
     Keyword Arguments:
-    blocked -(bool)- walkable if true, unwalkable if false
-    block_sight -(bool)- for FOV, blocks LOS if true
+    cell_size -(int)- width and height of one bucket, in tiles
     """
 
-    def __init__(self, blocked, block_sight=None):
-        self.blocked = blocked
-        self.explored = False
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.buckets = {}
+
+    def _cells(self, room):
+        size = self.cell_size
+        for cx in range(room.x1 // size, room.x2 // size + 1):
+            for cy in range(room.y1 // size, room.y2 // size + 1):
+                yield cx, cy
+
+    def intersects(self, room):
+        for cell in self._cells(room):
+            for other in self.buckets.get(cell, ()):
+                if room.intersect(other):
+                    return True
+        return False
+
+    def insert(self, room):
+        for cell in self._cells(room):
+            self.buckets.setdefault(cell, []).append(room)
+
 
-        if block_sight is None:
-            block_sight = blocked
-        self.block_sight = block_sight
+class Field:
+    """The dungeon floor, stored as boolean arrays indexed [x, y].
 
+    Keyword Arguments:
+    width -(int)- number of tiles across
+    height -(int)- number of tiles down
+
+    Arrays:
+    blocked -- walkable if false, unwalkable if true
+    block_sight -- for FOV, blocks LOS if true
+    explored -- true once the player has seen the tile
+    labels -- connected region of each walkable tile, see connect_components
+    occupants -- how many blocking entities stand on each tile
+
+    sight_cache -- what sight_from() saw from recently visited tiles, least
+        recently used first
+    light_cache -- the same for the light glow() spreads from a tile
+    light -- how much light falls on each tile, in 256ths of full light
+    lights -- the glow() each light source last added to light, by source
+    paths -- the floor's PathGraph, None until path_graph() is first called
+
+    Walls only change through set_walls(), which empties the caches and the
+    light, and patches paths. Stored floors leave them behind.
+    """
 
-def create_room(room):
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.blocked = np.ones((width, height), dtype=bool)
+        self.block_sight = np.ones((width, height), dtype=bool)
+        self.explored = np.zeros((width, height), dtype=bool)
+        self.labels = None
+        self.free_tiles = {}
+        self.occupants = np.zeros((width, height), dtype=np.int16)
+        self.sight_cache = OrderedDict()
+        self.light_cache = OrderedDict()
+        self.light = np.zeros((width, height), dtype=np.int32)
+        self.lights = {}
+        self.paths = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['sight_cache'] = OrderedDict()
+        state['light_cache'] = OrderedDict()
+        state['light'] = np.zeros_like(self.light)
+        state['lights'] = {}
+        state['paths'] = None
+        return state
+
+    def path_graph(self):
+        if self.paths is None:
+            self.paths = PathGraph(self)
+        return self.paths
+
+    def set_walls(self, where, walls):
+        """Makes the tiles at `where`, any index into the arrays, walls where
+        `walls` is true and open floor where it is false"""
+
+        self.blocked[where] = walls
+        self.block_sight[where] = walls
+        self.sight_cache.clear()
+        self.light_cache.clear()
+        self.light[:] = 0
+        self.lights = {}
+        if self.paths is not None:
+            self.paths.forget(where)
+
+    def carve(self, x1, x2, y1, y2):
+        # Make the tiles in [x1, x2) x [y1, y2) walkable
+        self.set_walls((slice(x1, x2), slice(y1, y2)), False)
+
+    def occupy(self, ent):
+        """Starts counting a blocking entity in occupants. From then on it
+        has to move with Entity.place() until vacate() is called"""
+
+        self.occupants[ent.x, ent.y] += 1
+        ent.occupying = self
+
+    def vacate(self, ent):
+        if ent.occupying is self:
+            self.occupants[ent.x, ent.y] -= 1
+            ent.occupying = None
+
+
+FloorReport = namedtuple('FloorReport',
+                         ['generator', 'rooms', 'connections', 'repairs',
+                          'gen_time'])
+
+
+def create_room(fld, room):
     # Pass this a Rect and it will make it a walkable space
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            field[x][y].blocked = False
-            field[x][y].block_sight = False
+    fld.carve(room.x1 + 1, room.x2, room.y1 + 1, room.y2)
 
 
-def create_h_tunnel(x1, x2, y):
-    for x in range(min(x1, x2), max(x1, x2) + 1):
-        field[x][y].blocked = False
-        field[x][y].block_sight = False
+def create_h_tunnel(fld, x1, x2, y):
+    fld.carve(min(x1, x2), max(x1, x2) + 1, y, y + 1)
 
 
-def create_v_tunnel(y1, y2, x):
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        field[x][y].blocked = False
-        field[x][y].block_sight = False
+def create_v_tunnel(fld, y1, y2, x):
+    fld.carve(x, x + 1, min(y1, y2), max(y1, y2) + 1)
 
 
-def create_random_tunnel(room1, room2):
-    thisx, thisy = room1.random_tile()
-    prevx, prevy = room2.random_tile()
+def create_random_tunnel(fld, room1, room2):
+    this_tile = room1.random_tile(fld)
+    prev_tile = room2.random_tile(fld)
+    # connect_components() joins up anything this has to skip
+    if this_tile is None or prev_tile is None:
+        return
+    thisx, thisy = this_tile
+    prevx, prevy = prev_tile
 
     if randint(0, 1):
-        create_h_tunnel(prevx, thisx, prevy)
-        create_v_tunnel(prevy, thisy, thisx)
+        create_h_tunnel(fld, prevx, thisx, prevy)
+        create_v_tunnel(fld, prevy, thisy, thisx)
     else:
-        create_v_tunnel(prevy, thisy, thisx)
-        create_h_tunnel(prevx, thisx, prevy)
+        create_v_tunnel(fld, prevy, thisy, thisx)
+        create_h_tunnel(fld, prevx, thisx, prevy)
 
 
 def is_blocked(x, y):
-    if field[x][y].blocked:
-        return True
+    return bool(game.field.blocked[x, y] or game.field.occupants[x, y])
 
-    for obj in objects:
-        if obj.blocks and obj.x == x and obj.y == y:
-            return True
 
-    return False
+def blocking_map():
+    """Returns an array marking every tile a blocking entity stands on"""
 
+    return game.field.occupants > 0
 
-def is_visible_tile(x, y):
-    # global field
 
-    if x >= field_width or x < 0:
-        return False
-    elif y >= field_height or y < 0:
-        return False
-    elif field[x][y].blocked:
-        return False
-    elif field[x][y].block_sight:
-        return False
-    else:
-        return True
+def label_components(walkable):
+    """Labels the regions of walkable tiles joined by orthogonal steps
+
+    A generator, yielding after every pass over the map. Returns an int array
+    shaped like walkable, holding 0 for unwalkable tiles and 1..n for the n
+    regions, along with n
+    """
 
+    width, height = walkable.shape
+    wall = width * height
+    # Every walkable tile starts labelled with its own flat index
+    labels = np.where(walkable, np.arange(wall).reshape(width, height), wall)
+
+    while True:
+        padded = np.pad(labels, 1, constant_values=wall)
+        lowest = np.minimum.reduce([labels,
+                                    padded[:-2, 1:-1], padded[2:, 1:-1],
+                                    padded[1:-1, :-2], padded[1:-1, 2:]])
+        lowest = np.where(walkable, lowest, wall)
+        # Look up the label of the tile each label names, so labels jump
+        # along long corridors instead of creeping one tile per pass
+        lowest = np.append(lowest.ravel(), wall)[lowest]
+        if np.array_equal(lowest, labels):
+            break
+        labels = lowest
+        yield
 
-def make_field():
-    global field
-    rooms = []
+    ids, inverse = np.unique(labels, return_inverse=True)
+    labels = inverse.reshape(width, height) + 1
+    labels[~walkable] = 0
+    return labels, len(ids) - int(ids[-1] == wall)
+
+
+def connect_components(fld):
+    """Makes every walkable tile of fld reachable from every other one
+
+    Regions smaller than region_min are filled in, the rest are tunnelled to
+    the largest region. Afterwards fld.labels marks the walkable tiles with 1
+    and fld.free_tiles maps each region label to its list of tiles.
+
+    A generator like the floor generators. Returns the number of tunnels dug
+    """
+
+    repairs = 0
+    while True:
+        labels, count = yield from label_components(~fld.blocked)
+        if count <= 1:
+            break
+
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        main = sizes.argmax()
+
+        small = sizes < region_min
+        small[0] = False
+        tiny = small[labels]
+        if tiny.any():
+            fld.set_walls(tiny, True)
+            yield
+            continue
+
+        # Dig from the first stray region to the closest tile of the main one
+        stray = labels == (1 if main != 1 else 2)
+        stray_tiles = np.argwhere(stray)
+        main_tiles = np.argwhere(labels == main)
+        x1, y1 = stray_tiles[randint(0, len(stray_tiles) - 1)]
+        x2, y2 = main_tiles[np.abs(main_tiles - (x1, y1)).sum(axis=1).argmin()]
+        x1, y1 = stray_tiles[np.abs(stray_tiles - (x2, y2)).sum(axis=1).argmin()]
+        create_h_tunnel(fld, x1, x2, y1)
+        create_v_tunnel(fld, y1, y2, x2)
+        repairs += 1
+        yield
+
+    fld.labels = labels
+    fld.free_tiles = {
+        label: np.argwhere(labels == label).tolist()
+        for label in range(1, count + 1)}
+    return repairs
+
+
+def random_free_tile(label=1):
+    """Picks a random walkable tile that no blocking entity stands on
+
+    Keyword Arguments:
+    label -(int)- the connected region to pick from, see connect_components
+
+    Returns None if the region has no free tile
+    """
+
+    tiles = game.field.free_tiles[label]
+    for _ in range(free_tile_tries):
+        x, y = tiles[randint(0, len(tiles) - 1)]
+        if not is_blocked(x, y):
+            return x, y
+
+    # Crowded, so go through the whole region once
+    for x, y in tiles:
+        if not is_blocked(x, y):
+            return x, y
+    return None
+
+
+def nearest_free_tile(x, y):
+    """Returns the walkable tile fewest steps from (x, y) that no blocking
+    entity stands on, (x, y) itself if it is free or no tile is
+    """
+
+    if not is_blocked(x, y):
+        return x, y
+
+    fld = game.field
+    free = ~fld.blocked & ~blocking_map()
+    goals = np.zeros(fld.blocked.shape, dtype=bool)
+    goals[x, y] = True
+    for dist in iter_distance_map(~fld.blocked, goals):
+        # None of the tiles reached in fewer steps was free
+        found = np.argwhere((dist >= 0) & free)
+        if len(found):
+            return tuple(found[0].tolist())
+    return x, y
 
-    # TODO: more complex room generation?
-    # TODO: minimum number of rooms?
-    # TODO: new room shapes
-    # TODO: Special rooms, shops, genies, etc.
 
-    # The largest height or width of a room
-    room_max = 13
-    # The smallest h or w
-    room_min = 5
-    # Maximum number of rooms a map may generate
-    room_num = 50
+# # Floor generators # #
+# Each generator carves a Field and returns (rooms, connections), where
+# connections are index pairs of the rooms joined by a tunnel. They are Python
+# generators too, yielding between steps so a floor can be built a slice at a
+# time while the player thinks, see iter_generate_floor().
 
-    # Create a 2D array of Tiles
-    field = [
-        [Tile(True) for _ in range(field_height)] for _ in range(field_width)]
 
-    for r in range(room_num):
+def generate_rooms(fld):
+    """Scatters non-overlapping rectangular rooms and chains them together"""
+
+    rooms = []
+    connections = []
+    index = RoomIndex(room_max + 1)
+
+    for _ in range(room_num):
         w = randint(room_min, room_max)
         h = randint(room_min, room_max)
-        x = randint(0, field_width - w - 1)
-        y = randint(0, field_height - h - 1)
+        x = randint(0, fld.width - w - 1)
+        y = randint(0, fld.height - h - 1)
 
         this_room = Rect(x, y, w, h)
-        fail = False
-
-        # Check for overlapping rooms
-        for other_room in rooms:
-            if this_room.intersect(other_room):
-                fail = True
-                break
 
         # If this room doesn't overlap others, use it
-        if not fail:
-            create_room(this_room)
+        if not index.intersects(this_room):
+            create_room(fld, this_room)
+            if rooms:
+                create_random_tunnel(fld, this_room, rooms[-1])
+                connections.append((len(rooms) - 1, len(rooms)))
+            index.insert(this_room)
+            rooms.append(this_room)
+            yield
 
-            try:
-                prev_room = rooms[len(rooms) - 1]
-            except IndexError:
-                place_objects(this_room)
-                rooms.append(this_room)
-                continue
+    return rooms, connections
+
+
+def generate_bsp(fld):
+    """Splits the field in two recursively and puts a room in every leaf.
+    Sibling halves are joined through one room from each side.
+    """
+
+    rooms = []
+    connections = []
+    leaf_min = room_min + 2
+
+    def split(x, y, w, h):
+        # Returns the indices of the rooms created inside this node
+        can_split_w = w >= leaf_min * 2
+        can_split_h = h >= leaf_min * 2
+        if (w <= room_max + 2 and h <= room_max + 2) or \
+                not (can_split_w or can_split_h):
+            room_w = randint(room_min, min(room_max, w - 1))
+            room_h = randint(room_min, min(room_max, h - 1))
+            room = Rect(x + randint(0, w - room_w - 1),
+                        y + randint(0, h - room_h - 1),
+                        room_w, room_h)
+            create_room(fld, room)
+            rooms.append(room)
+            yield
+            return [len(rooms) - 1]
+
+        if can_split_w and (not can_split_h or w > h):
+            cut = randint(leaf_min, w - leaf_min)
+            first = yield from split(x, y, cut, h)
+            second = yield from split(x + cut, y, w - cut, h)
+        else:
+            cut = randint(leaf_min, h - leaf_min)
+            first = yield from split(x, y, w, cut)
+            second = yield from split(x, y + cut, w, h - cut)
+
+        a, b = first[-1], second[0]
+        create_random_tunnel(fld, rooms[a], rooms[b])
+        connections.append((a, b))
+        return first + second
+
+    yield from split(0, 0, fld.width - 1, fld.height - 1)
+    return rooms, connections
+
+
+def generate_caves(fld):
+    """Grows caves with a cellular automaton, then treats each block of
+    cave_cell tiles that holds enough floor as a room, chained by tunnels
+    """
+
+    walls = np.random.random((fld.width, fld.height)) < cave_fill
+
+    for _ in range(cave_steps):
+        # Count the walls among each tile's 8 neighbours, where the map edge
+        # counts as wall
+        padded = np.pad(walls, 1, constant_values=True)
+        neighbours = sum(
+            padded[1 + dx:1 + dx + fld.width, 1 + dy:1 + dy + fld.height]
+            .astype(np.int8)
+            for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy)
+        walls = (neighbours >= 5) | (walls & (neighbours >= 4))
+        yield
+
+    walls[0, :] = walls[-1, :] = True
+    walls[:, 0] = walls[:, -1] = True
+    fld.set_walls(Ellipsis, walls)
+    yield
+
+    rooms = []
+    connections = []
+    for x in range(0, fld.width - 1, cave_cell):
+        for y in range(0, fld.height - 1, cave_cell):
+            w = min(cave_cell, fld.width - 1 - x)
+            h = min(cave_cell, fld.height - 1 - y)
+            floor = np.count_nonzero(~walls[x:x + w + 1, y:y + h + 1])
+            if floor >= max(1, w * h // 4):
+                room = Rect(x, y, w, h)
+                if rooms:
+                    create_random_tunnel(fld, room, rooms[-1])
+                    connections.append((len(rooms) - 1, len(rooms)))
+                rooms.append(room)
+        yield
+
+    return rooms, connections
+
+
+floor_generators = {
+    'rooms' : generate_rooms,
+    'bsp' : generate_bsp,
+    'caves' : generate_caves
+}
+
+
+def floor_generator_chances(level=None):
+    return {
+        'rooms' : 100,
+        'bsp' : dungeon_escalation([[20, 3], [40, 6]], level),
+        'caves' : dungeon_escalation([[10, 5], [25, 8]], level)
+    }
+
+
+def iter_generate_floor(name, width, height):
+    """Runs the named floor generator on a fresh Field, yielding between its
+    steps. The gen_time reported only counts the time spent inside.
+
+    Returns the Field and a FloorReport of what was generated
+    """
+
+    fld = Field(width, height)
+
+    def steps():
+        rooms, connections = yield from floor_generators[name](fld)
+        repairs = yield from connect_components(fld)
+        return rooms, connections, repairs
+
+    job = steps()
+    gen_time = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            next(job)
+        except StopIteration as done:
+            rooms, connections, repairs = done.value
+            break
+        finally:
+            gen_time += time.perf_counter() - start
+        yield
+
+    return fld, FloorReport(name, rooms, connections, repairs, gen_time)
+
+
+def generate_floor(name, width, height):
+    """Runs iter_generate_floor() to the end in one go"""
+
+    job = iter_generate_floor(name, width, height)
+    while True:
+        try:
+            next(job)
+        except StopIteration as done:
+            return done.value
 
-            create_random_tunnel(this_room, prev_room)
-            place_objects(this_room)
-            rooms.append(this_room)
+
+def benchmark_generators(width, height, trials=20):
+    """Times every floor generator on a map of the given size
+
+    Returns a dict of generator name to mean generation time in seconds
+    """
+
+    times = {}
+    for name in floor_generators:
+        total = 0
+        for _ in range(trials):
+            total += generate_floor(name, width, height)[1].gen_time
+        times[name] = total / trials
+    return times
+
+
+def make_field(generator=None):
+    # TODO: minimum number of rooms?
+    # TODO: new room shapes
+    # TODO: Special rooms, shops, genies, etc.
+
+    # Use the layout generated ahead of time while waiting for input
+    if generator is None and game.next_floor is not None \
+            and game.next_floor[0] == game.dungeon_level:
+        game.field, game.floor_report = game.next_floor[1:]
+    else:
+        if generator is None:
+            generator = randomizer(floor_generator_chances())
+        game.field, game.floor_report = generate_floor(
+            generator, field_width, field_height)
+    game.next_floor = None
+    game.scheduler = Scheduler()
+    game.stairs = Entity(0, 0, '>', 'stairs', colors.white,
+                         always_visible=True)
+    game.objects = [game.player, game.stairs]
+    rooms = game.floor_report.rooms
+
+    for room in rooms:
+        place_objects(room)
 
     # The player starts in a random tile in a random room
+    # After connect_components() every walkable tile is in region 1,
+    # so the stairs can always be reached from here
     start_room = randint(0, len(rooms) - 1)
-    startx, starty = rooms[start_room].random_tile()
-    while is_blocked(startx, starty):
-        startx, starty = rooms[start_room].random_tile()
-
-    player.x, player.y = startx, starty
+    game.player.x, game.player.y = \
+        rooms[start_room].random_tile() or random_free_tile()
+    game.field.occupy(game.player)
+
+    # The way back up is wherever the player arrives
+    if game.dungeon_level > 1:
+        game.upstairs = Entity(game.player.x, game.player.y, '<', 'stairs up',
+                               colors.white, always_visible=True)
+        game.objects.append(game.upstairs)
+        game.upstairs.send_to_back()
+    else:
+        game.upstairs = None
 
     # TODO: random stair placement?
     # Maybe stairs should have a special room?
     # The stairs are in the last room in the list
-    stairs.x, stairs.y = rooms[-1].center()
-    stairs.send_to_back()
+    game.stairs.x, game.stairs.y = rooms[-1].center()
+    if game.field.blocked[game.stairs.x, game.stairs.y]:
+        game.stairs.x, game.stairs.y = \
+            rooms[-1].random_tile(game.field) or random_free_tile()
+    game.stairs.send_to_back()
 
-    # create a map for the astar pathfinding to use
-    new_astar_map()
+    # Things to get done while the player is thinking
+    schedule_idle(pregenerate_floor(game.dungeon_level + 1))
 
 
-def place_objects(room):
-    global dungeon_level
+# # Spawn tables # #
+# The tables only depend on the floor and the player's level, so they are
+# built once and shared by every game in the process. Treat them as read only.
+
+
+@lru_cache(maxsize=None)
+def monster_table(level, player_level):
+    """Returns (monster_max, monster_dict, monster_chances) for floor `level`
+    """
 
-    # Generate the monsters
     # TODO: Method for generating long dungeon escalation?
     # TODO: monster stat leveling formulae adjustment
     # exponential increase instead of linear?
@@ -814,10 +1773,10 @@ def place_objects(room):
         rate -- after how many levels the stat will increase
         """
 
-        return int(base + base * percentage * dungeon_level / rate)
+        return int(base + base * percentage * level / rate)
 
     def xp_gain(base):
-        return base + dungeon_level * player.level / 2
+        return base + level * player_level / 2
 
     monster_dict = {
         'kobold' : {
@@ -831,7 +1790,8 @@ def place_objects(room):
                 'xp' : xp_gain(30),
                 'mp' : 0,
                 'mag' : 0,
-                'death_func' : monster_death
+                'death_func' : monster_death,
+                'speed' : 100
             },
             'name' : 'kobold',
         },
@@ -846,7 +1806,8 @@ def place_objects(room):
                 'xp' : xp_gain(40),
                 'mp' : 0,
                 'mag' : 0,
-                'death_func' : monster_death
+                'death_func' : monster_death,
+                'speed' : 100
             },
             'name' : 'orc',
         },
@@ -861,68 +1822,44 @@ def place_objects(room):
                 'xp' : xp_gain(50),
                 'mp' : 0,
                 'mag' : 0,
-                'death_func' : behemoth_death
+                'death_func' : behemoth_death,
+                'speed' : 100
             },
             'name' : 'troll',
         }
     }
 
-    monster_max = dungeon_escalation([[2, 1], [3, 4], [5, 6]])
-    num_monsters = randint(0, monster_max)
+    monster_max = dungeon_escalation([[2, 1], [3, 4], [5, 6]], level)
 
     monster_chances = {
         'kobold' : dungeon_escalation(
-            [[100, 1], [90, 3], [84, 5], [78, 7], [60, 9]]),
+            [[100, 1], [90, 3], [84, 5], [78, 7], [60, 9]], level),
 
         'orc' : dungeon_escalation(
-            [[10, 3], [15, 5], [20, 7], [35, 9]]),
+            [[10, 3], [15, 5], [20, 7], [35, 9]], level),
 
         'troll' : dungeon_escalation(
-            [[1, 5], [2, 7], [5, 9]])}
-
-    for i in range(num_monsters):
-        x = randint(room.x1 + 1, room.x2 - 1)
-        y = randint(room.y1 + 1, room.y2 - 1)
-
-        if not is_blocked(x, y):
-            this_monster = monster_dict[randomizer(monster_chances)]
+            [[1, 5], [2, 7], [5, 9]], level)}
 
-            monster = Entity(x, y,
-                             this_monster['char'],
-                             this_monster['name'],
-                             this_monster['color'],
-                             blocks=True,
-                             fighter=Fighter(**this_monster['fighter']),
-                             ai=this_monster['ai']())
+    return monster_max, monster_dict, monster_chances
 
-            objects.append(monster)
 
-    # Generate the items
+@lru_cache(maxsize=None)
+def item_table(level):
+    """Returns (max_items, item_chances) for floor `level`"""
 
-    # TODO: Add more potion variations?
-    # TODO: More random potions -- like other RLs
-    # TODO: random equipment -- with keywords?
-    # make a method that generates stats combinations based on dungeon level
-    # TODO: clean up item storage and selection
-    # items and item modules may need to go into a different script
-    # Would rather have a dict of dicts with more readability
-    # item_dict = { heal, mana, etc }
-    # randomizer(item_dict) == { 'item_name' : 'health potion', ... }
-    # possibly a method for creating a random item, this section is getting big
-
-    max_items = dungeon_escalation([[1, 1], [2, 5], [3, 10]])
-    num_items = randint(0, max_items)
+    max_items = dungeon_escalation([[1, 1], [2, 5], [3, 10]], level)
     item_chances = {
         'Healing Potion' : dungeon_escalation(
-            [[100, 1], [90, 3], [80, 5], [70, 7], [60, 9]]),
+            [[100, 1], [90, 3], [80, 5], [70, 7], [60, 9]], level),
         'Mana Potion' : dungeon_escalation(
-            [[1, 1], [5, 3], [15, 5], [20, 7], [25, 9]]),
+            [[1, 1], [5, 3], [15, 5], [20, 7], [25, 9]], level),
         'Magic Missile' : dungeon_escalation(
-            [[1, 1], [10, 3], [15, 7]]),
+            [[1, 1], [10, 3], [15, 7]], level),
         'Blink' : dungeon_escalation(
-            [[1, 1], [5, 3], [10, 5], [15, 7]]),
+            [[1, 1], [5, 3], [10, 5], [15, 7]], level),
         'Friendship' : dungeon_escalation(
-            [[1, 1], [2, 5], [4, 9]]),
+            [[1, 1], [2, 5], [4, 9]], level),
         'Sword' : 5,
         'Shield' : 5,
         'Staff' : 5,
@@ -931,6 +1868,101 @@ def place_objects(room):
         'Cloak' : 5
     }
 
+    return max_items, item_chances
+
+
+def place_objects(room):
+    # Generate the monsters
+    monster_max, monster_dict, monster_chances = \
+        monster_table(game.dungeon_level, game.player.level)
+    num_monsters = randint(0, monster_max)
+
+    for i in range(num_monsters):
+        x = randint(room.x1 + 1, room.x2 - 1)
+        y = randint(room.y1 + 1, room.y2 - 1)
+
+        if not is_blocked(x, y):
+            add_monster(monster_dict[randomizer(monster_chances)], x, y)
+
+    # Generate the items
+
+    # TODO: Add more potion variations?
+    # TODO: More random potions -- like other RLs
+    # TODO: random equipment -- with keywords?
+    # make a method that generates stats combinations based on dungeon level
+    # TODO: clean up item storage and selection
+    # items and item modules may need to go into a different script
+    # Would rather have a dict of dicts with more readability
+    # item_dict = { heal, mana, etc }
+    # randomizer(item_dict) == { 'item_name' : 'health potion', ... }
+    # possibly a method for creating a random item, this section is getting big
+
+    max_items, item_chances = item_table(game.dungeon_level)
+    num_items = randint(0, max_items)
+    item_dict = item_templates()
+
+    for _ in range(num_items):
+        x = randint(room.x1 + 1, room.x2 - 1)
+        y = randint(room.y1 + 1, room.y2 - 1)
+
+        # Do not place items on blocked areas
+        if not is_blocked(x, y):
+            add_item(item_dict[randomizer(item_chances)], x, y)
+
+    # Light some of the rooms
+    if randint(1, 100) <= torch_chance:
+        x = randint(room.x1 + 1, room.x2 - 1)
+        y = randint(room.y1 + 1, room.y2 - 1)
+
+        if not is_blocked(x, y):
+            torch = Entity(x, y, '*', 'torch', colors.flame,
+                           always_visible=True, light=torch_radius)
+            game.objects.append(torch)
+            torch.send_to_back()
+
+
+def add_monster(template, x, y):
+    """Puts a new monster from a monster_table() template on the floor"""
+
+    monster = Entity(x, y,
+                     template['char'],
+                     template['name'],
+                     template['color'],
+                     blocks=True,
+                     fighter=Fighter(**template['fighter']),
+                     ai=template['ai']())
+
+    game.objects.append(monster)
+    game.field.occupy(monster)
+    game.scheduler.add(monster)
+    return monster
+
+
+def add_item(template, x, y):
+    """Puts a new item from an item_templates() template on the floor"""
+
+    item = Entity(x, y, template['item_char'],
+                  template['item_name'],
+                  template['item_color'],
+                  always_visible=True,
+
+                  item=Item(**template['item'])
+                  if template['item'] is not None else None,
+
+                  equipment=Equipment(**template['equipment'])
+                  if template['equipment'] is not None else None,
+
+                  light=template.get('item_light', 0))
+
+    game.objects.append(item)
+    item.send_to_back()
+    return item
+
+
+def item_templates():
+    """Returns the items that can be found on the current floor by name,
+    scaled to the floor and the player"""
+
     # item_dict literal entry template
     """
     '' : {
@@ -961,12 +1993,13 @@ def place_objects(room):
             'item' : {
                 'use_func' : healing,
                 'kwargs' : {
-                    'hp_lower' : int(round(player.fighter.max_hp
-                                           * (
-                                                   0.04 + player.fighter.regen * 0.011),
+                    'hp_lower' : int(round(game.player.fighter.max_hp
+                                           * (0.04 + game.player.fighter.regen
+                                              * 0.011),
                                            1)),
-                    'hp_upper' : int(player.fighter.max_hp
-                                     * (0.12 + (player.fighter.regen * 0.01))
+                    'hp_upper' : int(game.player.fighter.max_hp
+                                     * (0.12 + (game.player.fighter.regen
+                                                * 0.01))
                                      ),
                     'mp_cost' : 0
                 }
@@ -980,8 +2013,8 @@ def place_objects(room):
             'item' : {
                 'use_func' : mana_recovery,
                 'kwargs' : {
-                    'mp_lower' : int(player.fighter.max_mp * 0.05),
-                    'mp_upper' : int(player.fighter.max_mp * 0.12)
+                    'mp_lower' : int(game.player.fighter.max_mp * 0.05),
+                    'mp_upper' : int(game.player.fighter.max_mp * 0.12)
                 }
             },
             'equipment' : None
@@ -993,8 +2026,8 @@ def place_objects(room):
             'item' : {
                 'use_func' : magic_missile,
                 'kwargs' : {
-                    'caster' : player,
-                    'damage' : dungeon_level // 2 + 7,
+                    'caster' : game.player,
+                    'damage' : game.dungeon_level // 2 + 7,
                     'mp_cost' : 0
                 }
             },
@@ -1006,7 +2039,7 @@ def place_objects(room):
             'item_color' : colors.light_violet,
             'item' : {
                 'use_func' : teleport,
-                'kwargs' : {'ent' : player,
+                'kwargs' : {'ent' : game.player,
                             'mp_cost' : 0}
             },
             'equipment' : None
@@ -1022,7 +2055,7 @@ def place_objects(room):
             'equipment' : None
         },
         'Sword' : {
-            'item_name' : f'Lv{dungeon_level - 1} Sword',
+            'item_name' : f'Lv{game.dungeon_level - 1} Sword',
             'item_char' : 'l',
             'item_color' : colors.light_sky,
             'item' : None,
@@ -1030,14 +2063,14 @@ def place_objects(room):
                 'slot' : 'right hand',
                 'max_hp' : 0,
                 'max_mp' : 0,
-                'power' : int(round(dungeon_level * 1.1)),
+                'power' : int(round(game.dungeon_level * 1.1)),
                 'defense' : 0,
                 'magick' : 0,
                 'regen' : 0
             }
         },
         'Shield' : {
-            'item_name' : f'Lv{dungeon_level - 1} Shield',
+            'item_name' : f'Lv{game.dungeon_level - 1} Shield',
             'item_char' : 'u',
             'item_color' : colors.light_sky,
             'item' : None,
@@ -1046,13 +2079,13 @@ def place_objects(room):
                 'max_hp' : 0,
                 'max_mp' : 0,
                 'power' : 0,
-                'defense' : int(round(dungeon_level * 1.3)),
+                'defense' : int(round(game.dungeon_level * 1.3)),
                 'magick' : 0,
                 'regen' : 0
             }
         },
         'Staff' : {
-            'item_name' : f'Lv{dungeon_level - 1} Staff',
+            'item_name' : f'Lv{game.dungeon_level - 1} Staff',
             'item_char' : 'Y',
             'item_color' : colors.light_sky,
             'item' : None,
@@ -1062,20 +2095,21 @@ def place_objects(room):
                 'max_mp' : 0,
                 'power' : 0,
                 'defense' : 0,
-                'magick' : int(round(dungeon_level * 1.1)),
+                'magick' : int(round(game.dungeon_level * 1.1)),
                 'regen' : 0
             }
         },
         'Orb' : {
-            'item_name' : f'Lv{dungeon_level - 1} Orb',
+            'item_name' : f'Lv{game.dungeon_level - 1} Orb',
             'item_char' : 'o',
             'item_color' : colors.light_sky,
+            'item_light' : 2,
             'item' : None,
             'equipment' : {
                 'slot' : 'left hand',
                 'max_hp' : 0,
-                'max_mp' : int(round(player.fighter.base_max_mp *
-                                     (0.09 + dungeon_level * 0.01))),
+                'max_mp' : int(round(game.player.fighter.base_max_mp *
+                                     (0.09 + game.dungeon_level * 0.01))),
                 'power' : 0,
                 'defense' : 0,
                 'magick' : 0,
@@ -1083,14 +2117,14 @@ def place_objects(room):
             }
         },
         'Bangle' : {
-            'item_name' : f'Lv{dungeon_level - 1} Bangle',
+            'item_name' : f'Lv{game.dungeon_level - 1} Bangle',
             'item_char' : 'c',
             'item_color' : colors.light_sky,
             'item' : None,
             'equipment' : {
                 'slot' : 'accessory',
-                'max_hp' : int(round(player.fighter.max_hp *
-                                     (0.04 + dungeon_level * 0.01))),
+                'max_hp' : int(round(game.player.fighter.max_hp *
+                                     (0.04 + game.dungeon_level * 0.01))),
                 'max_mp' : 0,
                 'power' : 0,
                 'defense' : 0,
@@ -1099,7 +2133,7 @@ def place_objects(room):
             }
         },
         'Cloak' : {
-            'item_name' : f'Lv{dungeon_level - 1} Cloak',
+            'item_name' : f'Lv{game.dungeon_level - 1} Cloak',
             'item_char' : '&',
             'item_color' : colors.light_sky,
             'item' : None,
@@ -1110,32 +2144,12 @@ def place_objects(room):
                 'power' : 0,
                 'defense' : 0,
                 'magick' : 0,
-                'regen' : int(1 + round(dungeon_level / 2))
+                'regen' : int(1 + round(game.dungeon_level / 2))
             }
         }
     }
 
-    for _ in range(num_items):
-        x = randint(room.x1 + 1, room.x2 - 1)
-        y = randint(room.y1 + 1, room.y2 - 1)
-
-        # Do not place items on blocked areas
-        if not is_blocked(x, y):
-            item_chosen = item_dict[randomizer(item_chances)]
-
-            item = Entity(x, y, item_chosen['item_char'],
-                          item_chosen['item_name'],
-                          item_chosen['item_color'],
-                          always_visible=True,
-
-                          item=Item(**item_chosen['item'])
-                          if item_chosen['item'] is not None else None,
-
-                          equipment=Equipment(**item_chosen['equipment'])
-                          if item_chosen['equipment'] is not None else None)
-
-            objects.append(item)
-            item.send_to_back()
+    return item_dict
 
 
 def random_index(chances):
@@ -1163,7 +2177,7 @@ def randomizer(chance_dict):
     return strings[random_index(chances)]
 
 
-def dungeon_escalation(table):
+def dungeon_escalation(table, floor=None):
     """ Picks the pair with the highest 1th entry that is <= dungeon_level and
     returns the 0th entry in that pair or 0
 
@@ -1171,46 +2185,536 @@ def dungeon_escalation(table):
         table -(list)- this list must contain entries which consist of two
     values, either as tuples or lists in the order [value, level], where
     value represents that item's portion of the drop pool and
-    level represents which floor to start having that likelihood"""
+    level represents which floor to start having that likelihood
+        floor -(int)- look up this floor instead of dungeon_level"""
+
+    if floor is None:
+        floor = game.dungeon_level
 
     for (value, level) in reversed(table):
-        if dungeon_level >= level:
+        if floor >= level:
             return value
     return 0
 
 
 def next_level():
-    global dungeon_level, fov_recompute, objects
-
-    fov_recompute = True
-    dungeon_level += 1
-    objects = [player, stairs]
+    game.fov_recompute = True
+    store_floor()
+    game.dungeon_level += 1
+    game.hud.mark('floor')
+
+    # Been here before, come back in by the stairs up, or next to them if
+    # a monster stands there
+    if restore_floor(game.dungeon_level):
+        game.player.x, game.player.y = nearest_free_tile(game.upstairs.x,
+                                                         game.upstairs.y)
+        game.field.occupy(game.player)
+        return
 
     regen_hp, regen_mp = player_regen()
-    player.fighter.heal(health=regen_hp, mana=regen_mp)
+    game.player.fighter.heal(health=regen_hp, mana=regen_mp)
 
     message('During a calm moment, you find time to rest...', colors.white)
     message(f'You regained {regen_hp} hp.', colors.light_red)
     message(f'You regained {regen_mp} mp.', colors.light_blue)
     message('Back to work...', colors.chartreuse)
 
-    con.clear(fg=colors.black, bg=colors.black)
-    root.clear(fg=colors.black, bg=colors.black)
     make_field()
 
 
-def new_astar_map():
-    bool_field = [[0 for _ in range(field_width)] for _ in range(field_height)]
+def prev_level():
+    game.fov_recompute = True
+    store_floor()
+    game.dungeon_level -= 1
+    game.hud.mark('floor')
+
+    # Every floor above this one has been visited, so it is cached
+    restore_floor(game.dungeon_level)
+    game.player.x, game.player.y = nearest_free_tile(game.stairs.x,
+                                                     game.stairs.y)
+    game.field.occupy(game.player)
+
+
+# # Floor cache # #
+# Visited floors are kept in floor_cache, most recently left last. Past
+# floor_cache_size floors, the oldest are pickled, compressed and written to
+# floor_dir by an idle job.
+
+
+SavedFloor = namedtuple('SavedFloor', ['field', 'report', 'objects', 'stairs',
+                                       'upstairs', 'scheduler'])
+
+
+class FloorPickler(pickle.Pickler):
+    """Pickles a floor without the player, who is still alive and well"""
+
+    def persistent_id(self, obj):
+        if obj is game.player:
+            return 'player'
+        return None
 
-    for y in range(field_height):
-        for x in range(field_width):
-            bool_field[y][x] = 0 if field[x][y].blocked else 1
 
-    for obj in objects:
-        bool_field[obj.y][obj.x] = 1
+class FloorUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        if pid == 'player':
+            return game.player
+        raise pickle.UnpicklingError(f'unknown persistent id {pid}')
 
-    dungeon = np.array(bool_field, dtype=np.int8)
-    return tcod.path.AStar(dungeon)
+
+def store_floor():
+    # The player leaves with the floor's occupants counted without them
+    game.field.vacate(game.player)
+    game.flashes = []
+    game.floor_cache[game.dungeon_level] = SavedFloor(
+        game.field, game.floor_report, game.objects, game.stairs,
+        game.upstairs, game.scheduler)
+    game.floor_cache.move_to_end(game.dungeon_level)
+    if len(game.floor_cache) > floor_cache_size * 2:
+        # The player never paused long enough for the idle job, spill now
+        for _ in spill_floors():
+            pass
+    elif len(game.floor_cache) > floor_cache_size:
+        schedule_idle(spill_floors())
+
+
+def spill_floors():
+    """Idle job writing the least recently left floors to disk, one per slice,
+    until floor_cache_size are left in memory"""
+
+    while len(game.floor_cache) > floor_cache_size:
+        level, saved = game.floor_cache.popitem(last=False)
+        buffer = io.BytesIO()
+        FloorPickler(buffer, pickle.HIGHEST_PROTOCOL).dump(saved)
+        path = os.path.join(game.floor_dir.name, f'floor{level}.bin')
+        with open(path, 'wb') as spill:
+            spill.write(zlib.compress(buffer.getvalue()))
+        game.spilled_floors[level] = path
+        yield
+
+
+def restore_floor(level):
+    """Makes the visited floor `level` the current floor again
+    Returns False if it has never been visited
+    """
+
+    if level in game.floor_cache:
+        saved = game.floor_cache.pop(level)
+    elif level in game.spilled_floors:
+        path = game.spilled_floors.pop(level)
+        with open(path, 'rb') as spill:
+            data = zlib.decompress(spill.read())
+        os.remove(path)
+        saved = FloorUnpickler(io.BytesIO(data)).load()
+    else:
+        return False
+
+    (game.field, game.floor_report, game.objects, game.stairs, game.upstairs,
+     game.scheduler) = saved
+    return True
+
+
+# # Pathfinding # #
+
+
+class PathGraph:
+    """Finds the way across a floor in two levels, so far targets don't
+    cost a search over every tile in between
+
+    The floor is cut into square clusters path_cluster tiles across.
+    Wherever two neighbouring clusters share a run of open border, the
+    middle of the run is a portal joining them. Far targets are searched for
+    over the portals, knowing how many steps apart the portals of each
+    cluster are, and the step towards the first portal is read off the
+    steps from it to every tile of its cluster. Near targets are searched
+    for tile by tile, in the clusters around both ends. Entities don't block
+    paths, they are only in the way when moving.
+
+    What a cluster holds is worked out the first time a search passes
+    through it, and forget() drops it again for clusters whose walls
+    changed. Searches run on the planning pool: at worst two threads work
+    out the same cluster and store equal results.
+    """
+
+    def __init__(self, fld):
+        self.fld = fld
+        self.size = path_cluster
+        # Portals by (cx, cy, axis), the border with the next cluster along
+        # x (axis 0) or y (axis 1)
+        self.borders = {}
+        # By (cx, cy), each portal of the cluster with its neighbours in the
+        # portal graph, as lists of (tile, steps)
+        self.links = {}
+        # By (cx, cy), each portal of the cluster with the steps from it to
+        # every tile of the cluster, -1 where it can't walk inside it
+        self.spreads = {}
+        # By goal tile, the distance_map() to it of the last few goals many
+        # entities head for at once, see flow()
+        self.flows = {}
+        self.flow_lock = threading.Lock()
+        # The tcod path map, indexed [x, y] like the field, walkable tiles
+        # are 1
+        self.costs = (~self.fld.blocked).astype(np.int8)
+
+    def cluster(self, x, y):
+        return x // self.size, y // self.size
+
+    def window(self, cx, cy):
+        s = self.size
+        return (slice(cx * s, min((cx + 1) * s, self.fld.width)),
+                slice(cy * s, min((cy + 1) * s, self.fld.height)))
+
+    def border(self, cx, cy, axis):
+        """Returns the portals from cluster (cx, cy) to the next one along
+        `axis`, as pairs of the tiles facing each other across the border
+        """
+
+        key = cx, cy, axis
+        portals = self.borders.get(key)
+        if portals is None:
+            xs, ys = self.window(cx, cy)
+            walkable = ~self.fld.blocked
+            if axis == 0:
+                edge, start, limit = xs.stop - 1, ys.start, self.fld.width
+            else:
+                edge, start, limit = ys.stop - 1, xs.start, self.fld.height
+            if edge + 1 >= limit:
+                facing = np.zeros(0, dtype=bool)
+            elif axis == 0:
+                facing = walkable[edge, ys] & walkable[edge + 1, ys]
+            else:
+                facing = walkable[xs, edge] & walkable[xs, edge + 1]
+
+            # Open runs start where facing turns true and end where it turns
+            # false again
+            turns = np.diff(np.concatenate(([0], facing, [0]))
+                            .astype(np.int8))
+            middles = (np.flatnonzero(turns == 1)
+                       + np.flatnonzero(turns == -1) - 1) // 2 + start
+            middles = middles.tolist()
+            if axis == 0:
+                portals = [((edge, y), (edge + 1, y)) for y in middles]
+            else:
+                portals = [((x, edge), (x, edge + 1)) for x in middles]
+            self.borders[key] = portals
+        return portals
+
+    def portals(self, cx, cy):
+        """Returns the portals of cluster (cx, cy) with their neighbours, the
+        tile facing them across the border and the portals of the cluster
+        they can walk to, as lists of (tile, steps)
+        """
+
+        links = self.links.get((cx, cy))
+        if links is None:
+            links = {}
+            facing = self.border(cx, cy, 0) + self.border(cx, cy, 1)
+            if cx > 0:
+                facing += [(b, a) for a, b in self.border(cx - 1, cy, 0)]
+            if cy > 0:
+                facing += [(b, a) for a, b in self.border(cx, cy - 1, 1)]
+            for tile, other in facing:
+                links.setdefault(tile, []).append((other, 1))
+
+            window = self.window(cx, cy)
+            walkable = ~self.fld.blocked[window]
+            spreads = {}
+            for x, y in links:
+                goals = np.zeros(walkable.shape, dtype=bool)
+                goals[x - window[0].start, y - window[1].start] = True
+                spreads[x, y] = distance_map(walkable, goals)
+            for tile in links:
+                links[tile] += self.walk(spreads, window, tile)
+
+            # Other threads may be searching, so only finished clusters are
+            # stored, spreads first as reach() looks for them once links are
+            # there
+            self.spreads[cx, cy] = spreads
+            self.links[cx, cy] = links
+        return links
+
+    def reach(self, cluster, tile):
+        """Returns the portals of `cluster` which can be walked to from
+        `tile` without leaving the cluster, with how many steps it takes
+        """
+
+        self.portals(*cluster)
+        return self.walk(self.spreads[cluster], self.window(*cluster), tile)
+
+    @staticmethod
+    def walk(spreads, window, tile):
+        x, y = tile[0] - window[0].start, tile[1] - window[1].start
+        reached = []
+        for portal, spread in spreads.items():
+            steps = int(spread[x, y])
+            if steps > 0:
+                reached.append((portal, steps))
+        return reached
+
+    def first_portal(self, start, goal):
+        """Searches the portal graph for the way from tile `start` to tile
+        `goal` in another cluster
+        Returns the first tile on it after `start`, or None if the portals
+        don't lead there
+        """
+
+        gx, gy = goal
+        into_goal = dict(self.reach(self.cluster(gx, gy), goal))
+
+        # Ordered by estimated length, then the furthest along first, which
+        # keeps the search from spreading over open ground
+        order = itertools.count()
+        frontier = [(0, 0, next(order), start, None)]
+        done = set()
+        while frontier:
+            _, steps, _, tile, first = heapq.heappop(frontier)
+            steps = -steps
+            if tile == goal:
+                return first
+            if tile in done:
+                continue
+            done.add(tile)
+
+            cluster = self.cluster(*tile)
+            onward = self.portals(*cluster).get(tile, [])
+            if tile == start:
+                onward = onward + self.reach(cluster, start)
+            if tile in into_goal:
+                onward = onward + [(goal, into_goal[tile])]
+            for other, cost in onward:
+                if other not in done:
+                    total = steps + cost
+                    estimate = abs(gx - other[0]) + abs(gy - other[1])
+                    heapq.heappush(frontier, (total + estimate, -total,
+                                              next(order), other,
+                                              first or other))
+        return None
+
+    def step_down(self, x, y, portal):
+        """Returns the (dx, dy) from (x, y) to the next tile on the way to
+        `portal`, one of the portals of its cluster or the tile facing it
+        across a border, or None if the cluster has no such portal
+        """
+
+        px, py = portal
+        if abs(px - x) + abs(py - y) == 1:
+            return px - x, py - y
+
+        cluster = self.cluster(x, y)
+        self.portals(*cluster)
+        spread = self.spreads[cluster].get(portal)
+        if spread is None:
+            return None
+        xs, ys = self.window(*cluster)
+        x, y = x - xs.start, y - ys.start
+        steps = spread[x, y]
+        for dx, dy in ((0, -1), (0, 1), (-1, 0), (1, 0)):
+            if 0 <= x + dx < spread.shape[0] and \
+                    0 <= y + dy < spread.shape[1] and \
+                    0 <= spread[x + dx, y + dy] < steps:
+                return dx, dy
+
+    def search(self, x, y, tx, ty):
+        """Searches tile by tile for the way from (x, y) to (tx, ty) without
+        leaving the clusters holding them and the ones around those
+        Returns the first (dx, dy) on it, or None if there is none
+        """
+
+        s = self.size
+        x1 = max(min(x, tx) // s - 1, 0) * s
+        y1 = max(min(y, ty) // s - 1, 0) * s
+        x2 = min((max(x, tx) // s + 2) * s, self.fld.width)
+        y2 = min((max(y, ty) // s + 2) * s, self.fld.height)
+
+        # A view of costs, so each search only pays for its own window
+        astar = tcod.path.AStar(self.costs[x1:x2, y1:y2])
+        path = astar.get_path(x - x1, y - y1, tx - x1, ty - y1)
+        if path:
+            return path[0][0] + x1 - x, path[0][1] + y1 - y
+
+    def first_step(self, x, y, tx, ty):
+        """Returns the first (dx, dy) on a way from (x, y) to (tx, ty), or
+        None if there is none
+        Targets within path_portal_range clusters are searched for tile by
+        tile. Further ones, and near ones that search doesn't find, are
+        headed for through the first portal on the way to them.
+        """
+
+        (cx, cy), (gx, gy) = self.cluster(x, y), self.cluster(tx, ty)
+        if max(abs(gx - cx), abs(gy - cy)) <= path_portal_range:
+            step = self.search(x, y, tx, ty)
+            if step is not None:
+                return step
+
+        waypoint = self.first_portal((x, y), (tx, ty))
+        if waypoint is not None:
+            return self.step_down(x, y, waypoint)
+
+    def flow(self, x, y):
+        """Returns the steps from every tile to (x, y), -1 where it can't be
+        reached, for everyone heading there to walk down
+        The map is shared until path_flows other goals have asked for one.
+        """
+
+        dist = self.flows.get((x, y))
+        if dist is None:
+            # Threads wanting the same flow wait for the first one to make
+            # it instead of each spreading their own
+            with self.flow_lock:
+                dist = self.flows.get((x, y))
+                if dist is None:
+                    goals = np.zeros(self.costs.shape, dtype=bool)
+                    goals[x, y] = True
+                    dist = distance_map(~self.fld.blocked, goals)
+                    # Copied rather than added to, so threads reading flows
+                    # never see it change under them
+                    flows = (self.flows.copy()
+                             if len(self.flows) < path_flows else {})
+                    flows[x, y] = dist
+                    self.flows = flows
+        return dist
+
+    def forget(self, where):
+        """Drops what is known about the clusters holding any of the tiles
+        at `where`, any index into the floor's arrays, once their walls
+        changed
+        """
+
+        fld, s = self.fld, self.size
+        width, height = -(-fld.width // s), -(-fld.height // s)
+        touched = np.zeros((width * s, height * s), dtype=bool)
+        touched[:fld.width, :fld.height][where] = True
+        clusters = touched.reshape(width, s, height, s).any(axis=(1, 3))
+
+        for cx, cy in np.argwhere(clusters).tolist():
+            for key in ((cx, cy, 0), (cx, cy, 1),
+                        (cx - 1, cy, 0), (cx, cy - 1, 1)):
+                self.borders.pop(key, None)
+            for key in ((cx, cy), (cx - 1, cy), (cx + 1, cy),
+                        (cx, cy - 1), (cx, cy + 1)):
+                self.links.pop(key, None)
+                self.spreads.pop(key, None)
+        self.costs[where] = ~fld.blocked[where]
+        self.flows = {}
+
+
+# # # # # # # # # # # # # # # # # # # #
+#   Idle Work
+# # # # # # # # # # # # # # # # # # # #
+# Jobs are generators. Each next() should be a short slice of work, so a key
+# press never waits long for the slice in progress to finish.
+
+
+def schedule_idle(job):
+    game.idle_jobs.append(job)
+
+
+def run_idle_slice():
+    """Steps the oldest idle job once
+    Returns False if there was nothing left to do
+    """
+
+    while game.idle_jobs:
+        try:
+            next(game.idle_jobs[0])
+            return True
+        except StopIteration:
+            game.idle_jobs.popleft()
+    return False
+
+
+def iter_distance_map(walkable, goals):
+    """Spreads out from the goal tiles one orthogonal step per iteration
+
+    Yields the distance map so far, an int array holding the number of steps
+    to the nearest goal or -1 where no step has reached yet
+    """
+
+    dist = np.full(walkable.shape, -1, dtype=np.int32)
+    # The frontier is copied into the middle of a border that stays False,
+    # so its neighbours are slices of one array instead of a new pad per step
+    padded = np.zeros((walkable.shape[0] + 2, walkable.shape[1] + 2),
+                      dtype=bool)
+    frontier = goals & walkable
+    unreached = walkable & ~frontier
+    step = 0
+    while True:
+        dist[frontier] = step
+        yield dist
+        padded[1:-1, 1:-1] = frontier
+        frontier = padded[:-2, 1:-1] | padded[2:, 1:-1]
+        frontier |= padded[1:-1, :-2]
+        frontier |= padded[1:-1, 2:]
+        frontier &= unreached
+        if not frontier.any():
+            return
+        unreached ^= frontier
+        step += 1
+
+
+def distance_map(walkable, goals):
+    """Returns the finished distance map of iter_distance_map()"""
+
+    for dist in iter_distance_map(walkable, goals):
+        pass
+    return dist
+
+
+def pregenerate_floor(level):
+    """Idle job generating the layout of floor `level` ahead of time
+    Gives up if the player leaves for another floor before it is done
+    """
+
+    name = randomizer(floor_generator_chances(level))
+    job = iter_generate_floor(name, field_width, field_height)
+    while True:
+        try:
+            next(job)
+        except StopIteration as done:
+            game.next_floor = (level,) + done.value
+            return
+        yield
+        if game.dungeon_level != level - 1:
+            return
+
+
+def flush_telemetry():
+    """Idle job appending the buffered telemetry records to telemetry_path"""
+
+    records = game.telemetry[:]
+    del game.telemetry[:]
+    with open(telemetry_path, 'a') as log:
+        for record in records:
+            log.write(json.dumps(record) + '\n')
+    yield
+
+
+def poll_spectators():
+    """Lets in and catches up the current game's watchers between frames"""
+
+    for renderer in game.renderers:
+        if isinstance(renderer, Spectators):
+            renderer.poll()
+
+
+def wait_key():
+    """Waits for a key press like tdl.event.key_wait(), but runs idle jobs
+    instead of sleeping while no input is waiting
+    """
+
+    if game.session is not None:
+        return game.session.wait_key()
+
+    while True:
+        poll_spectators()
+        for event in tdl.event.get():
+            if event.type == 'KEYDOWN':
+                return event
+            if event.type == 'QUIT':
+                # Same as key_wait(), a closed window reads as alt+F4
+                return tdl.event.KeyDown('F4', '', True, False, True, False,
+                                         False)
+        if not run_idle_slice():
+            time.sleep(0.001)
 
 
 # # # # # # # # # # # # # # # # # # # #
@@ -1224,104 +2728,120 @@ def player_regen():
     [HP(MP)_MAX] * (14% + [REG%])
     """
 
-    regen_hp = int(player.fighter.max_hp
-                   * (0.14 + (player.fighter.regen * 0.01)))
-    regen_mp = int(player.fighter.max_mp
-                   * (0.14 + (player.fighter.regen * 0.01)))
+    regen_hp = int(game.player.fighter.max_hp
+                   * (0.14 + (game.player.fighter.regen * 0.01)))
+    regen_mp = int(game.player.fighter.max_mp
+                   * (0.14 + (game.player.fighter.regen * 0.01)))
 
     return regen_hp, regen_mp
 
 
 def cast_spell():
-    if len(player.spells) == 0:
+    if len(game.player.spells) == 0:
         spell_menu = ["You don't know any spells"]
     else:
-        spell_menu = [s for s in player.spells]
+        spell_menu = [s for s in game.player.spells]
 
     spell = menu("Choose a spell to cast\n",
                  spell_menu,
                  spell_width)
 
-    if spell is None or len(player.spells) == 0:
+    if spell is None or len(game.player.spells) == 0:
         return 'cancel'
-    elif player.spells[spell] == 'Magic Missile':
-        magic_missile(caster=player, damage=int(player.fighter.mag * 0.5),
+    elif game.player.spells[spell] == 'Magic Missile':
+        magic_missile(caster=game.player,
+                      damage=int(game.player.fighter.mag * 0.5),
                       mp_cost=5)
 
-    elif player.spells[spell] == 'Minor Heal':
-        healing(hp_lower=int(player.fighter.mag * 0.25),
-                hp_upper=int(player.fighter.mag * 0.75),
+    elif game.player.spells[spell] == 'Minor Heal':
+        healing(hp_lower=int(game.player.fighter.mag * 0.25),
+                hp_upper=int(game.player.fighter.mag * 0.75),
                 mp_cost=3)
-    elif player.spells[spell] == 'Blink':
-        teleport(ent=player,
+    elif game.player.spells[spell] == 'Blink':
+        teleport(ent=game.player,
                  mp_cost=2)
 
+    elif game.player.spells[spell] == 'Frost Cone':
+        return area_spell('frost cone', 'cone', reach=5,
+                          damage=int(game.player.fighter.mag * 0.4),
+                          mp_cost=6, stun=2)
+    elif game.player.spells[spell] == 'Lightning Bolt':
+        return area_spell('lightning bolt', 'line', reach=fov_radius,
+                          damage=int(game.player.fighter.mag * 0.5),
+                          mp_cost=7)
+    elif game.player.spells[spell] == 'Shockwave':
+        return area_spell('shockwave', 'burst', reach=2,
+                          damage=int(game.player.fighter.mag * 0.4),
+                          mp_cost=9, stun=1)
+
     else:
         return 'cancel'
 
 
-adv_hp_count = 0
-adv_mp_count = 0
-adv_str_count = 0
-adv_mag_count = 0
-
-
 def check_level_up():
-    global adv_hp_count, adv_mp_count, adv_str_count, adv_mag_count
+    level_up_xp = level_up_base + game.player.level * level_up_factor
 
-    level_up_xp = level_up_base + player.level * level_up_factor
-
-    if player.fighter.xp >= level_up_xp:
-        player.level += 1
-        player.fighter.xp -= level_up_xp
+    if game.player.fighter.xp >= level_up_xp:
+        game.player.level += 1
+        game.player.fighter.xp -= level_up_xp
+        game.hud.mark('xp')
         message('You feel stronger!', colors.yellow)
 
         # Scaling stat advancement
 
         # HP
-        adv_hp = (player.fighter.base_max_hp * 0.15) - (adv_hp_count * 0.005)
-        if adv_hp < player.fighter.base_max_hp * 0.04:
-            adv_hp = int(player.fighter.base_max_hp * 0.04)
+        adv_hp = (game.player.fighter.base_max_hp * 0.15) \
+            - (game.adv_hp_count * 0.005)
+        if adv_hp < game.player.fighter.base_max_hp * 0.04:
+            adv_hp = int(game.player.fighter.base_max_hp * 0.04)
         else:
             adv_hp = int(adv_hp)
 
         # MP
-        adv_mp = (player.fighter.base_max_mp * 0.2) - (adv_mp_count * 0.0075)
-        if adv_mp < player.fighter.base_max_mp * 0.04:
-            adv_mp = int(player.fighter.base_max_mp * 0.04)
+        adv_mp = (game.player.fighter.base_max_mp * 0.2) \
+            - (game.adv_mp_count * 0.0075)
+        if adv_mp < game.player.fighter.base_max_mp * 0.04:
+            adv_mp = int(game.player.fighter.base_max_mp * 0.04)
         else:
             adv_mp = int(adv_mp)
 
         # TODO: Better formula for str & mag advancement?
         # STR
-        adv_str = 2 if adv_str_count % 2 == 0 else 1
+        adv_str = 2 if game.adv_str_count % 2 == 0 else 1
 
         # MAG
-        adv_mag = 2 if adv_mag_count % 2 == 0 else 1
+        adv_mag = 2 if game.adv_mag_count % 2 == 0 else 1
 
         # TODO: def & reg formulae?
 
-        choice_list = [f'HP: {player.fighter.base_max_hp} (+ {adv_hp})',
-                       f'MP: {player.fighter.base_max_mp} (+ {adv_mp})',
-                       f'STR: {player.fighter.base_power} (+ {adv_str})',
-                       f'MAG: {player.fighter.base_mag} (+ {adv_mag})',
-                       f'DEF: {player.fighter.base_defense} (+ 1)',
-                       f'REG: {player.fighter.base_regen} (+ 1)']
+        choice_list = [f'HP: {game.player.fighter.base_max_hp} (+ {adv_hp})',
+                       f'MP: {game.player.fighter.base_max_mp} (+ {adv_mp})',
+                       f'STR: {game.player.fighter.base_power} (+ {adv_str})',
+                       f'MAG: {game.player.fighter.base_mag} (+ {adv_mag})',
+                       f'DEF: {game.player.fighter.base_defense} (+ 1)',
+                       f'REG: {game.player.fighter.base_regen} (+ 1)']
 
         # Add available skills and spells
-        if player.level >= 2 and 'Minor Heal' not in player.spells:
+        if game.player.level >= 2 and 'Minor Heal' not in game.player.spells:
             choice_list.append('Minor Heal')
-        if player.level >= 5 \
-                and 'Magic Missile' not in player.spells \
-                and 'Blink' not in player.spells:
+        if game.player.level >= 5 \
+                and 'Magic Missile' not in game.player.spells \
+                and 'Blink' not in game.player.spells:
             choice_list.append('Magic Missile')
             choice_list.append('Blink')
-        elif player.level >= 7 \
-                and 'Magic Missile' not in player.spells:
+        elif game.player.level >= 7 \
+                and 'Magic Missile' not in game.player.spells:
             choice_list.append('Magic Missile')
-        elif player.level >= 7 \
-                and 'Blink' not in player.spells:
+        elif game.player.level >= 7 \
+                and 'Blink' not in game.player.spells:
             choice_list.append('Blink')
+        if game.player.level >= 4 and 'Frost Cone' not in game.player.spells:
+            choice_list.append('Frost Cone')
+        if game.player.level >= 6 \
+                and 'Lightning Bolt' not in game.player.spells:
+            choice_list.append('Lightning Bolt')
+        if game.player.level >= 8 and 'Shockwave' not in game.player.spells:
+            choice_list.append('Shockwave')
 
         choice = 'cancel'
         while choice is 'cancel':
@@ -1330,27 +2850,27 @@ def check_level_up():
                           level_up_width)
 
             if choice == 0:
-                player.fighter.base_max_hp += adv_hp
-                player.fighter.hp += adv_hp
-                adv_hp_count += 1
+                game.player.fighter.base_max_hp += adv_hp
+                game.player.fighter.hp += adv_hp
+                game.adv_hp_count += 1
             elif choice == 1:
-                player.fighter.base_max_mp += adv_mp
-                player.fighter.mp += adv_mp
-                adv_mp_count += 1
+                game.player.fighter.base_max_mp += adv_mp
+                game.player.fighter.mp += adv_mp
+                game.adv_mp_count += 1
             elif choice == 2:
-                player.fighter.base_power += adv_str
-                adv_str_count += 1
+                game.player.fighter.base_power += adv_str
+                game.adv_str_count += 1
             elif choice == 3:
-                player.fighter.base_mag += adv_mag
-                adv_mag_count += 1
+                game.player.fighter.base_mag += adv_mag
+                game.adv_mag_count += 1
             elif choice == 4:
-                player.fighter.base_defense += 1
+                game.player.fighter.base_defense += 1
             elif choice == 5:
-                player.fighter.base_regen += 1
+                game.player.fighter.base_regen += 1
             elif choice is 'cancel':
                 pass
-            elif choice_list[choice] not in player.spells:
-                player.spells.append(choice_list[choice])
+            elif choice_list[choice] not in game.player.spells:
+                game.player.spells.append(choice_list[choice])
 
 
 # def get_names_under_mouse():
@@ -1371,17 +2891,16 @@ def handle_keys():
     Returns 'no-turn' if the player did not take an action.
     """
 
-    global fov_recompute, game_state
     # global mouse_coord
 
-    user_input = tdl.event.key_wait()
+    user_input = wait_key()
 
     # esc: quit
     if user_input.key == 'ESCAPE':
         return 'exit'
 
     # TODO: do we even need the play and dead states?
-    if game_state == 'play':
+    if game.game_state == 'play':
         # # Actions which take a turn
 
         # Move the player with the arrow keys
@@ -1398,6 +2917,18 @@ def handle_keys():
         elif user_input.key == 'SPACE':
             message('You twiddle your thumbs')
 
+        # x: explore until something turns up
+        elif user_input.char == 'x':
+            return start_travel('explore')
+
+        # t: travel to the stairs down
+        elif user_input.char == 't':
+            return start_travel('stairs')
+
+        # z: rest until healed
+        elif user_input.char == 'z':
+            return start_travel('rest')
+
         # s: cast a spell
         elif user_input.char == 's':
             if cast_spell() == 'cancel':
@@ -1406,14 +2937,14 @@ def handle_keys():
         # i: use an item from inventory
         elif user_input.char == 'i':
             chosen_item = inventory_menu(
-                'Choose an item to use, esc to cancel\n', inventory)
+                'Choose an item to use, esc to cancel\n', game.inventory)
             if chosen_item != 'cancel':
                 chosen_item.use()
             else:
                 return 'no-turn'
         elif user_input.char == 'e':
             chosen_item = inventory_menu(
-                'Equipment\n', equipment)
+                'Equipment\n', game.equipment)
             if chosen_item != 'cancel':
                 chosen_item.use()
             else:
@@ -1423,27 +2954,36 @@ def handle_keys():
         else:
             # \: descend to the next level
             if user_input.char == '.':
-                if player.x == stairs.x and player.y == stairs.y:
+                if game.player.x == game.stairs.x \
+                        and game.player.y == game.stairs.y:
                     next_level()
 
+            # ,: climb back up to the previous level
+            elif user_input.char == ',':
+                if game.upstairs is not None \
+                        and game.player.x == game.upstairs.x \
+                        and game.player.y == game.upstairs.y:
+                    prev_level()
+
             # shift: pick up item beneath player
             elif user_input.key == 'SHIFT':
-                for item in objects:
-                    if item.x == player.x and item.y == player.y and item.item:
+                for item in game.objects:
+                    if item.x == game.player.x and item.y == game.player.y \
+                            and item.item:
                         item.item.pick_up()
                         break
 
             # o: drop an item from inventory
             elif user_input.char == 'o':
                 chosen_item = inventory_menu(
-                    'Choose an item to drop, esc to cancel\n', inventory)
+                    'Choose an item to drop, esc to cancel\n', game.inventory)
                 if chosen_item is not 'cancel':
                     chosen_item.drop()
 
             # r: drop an item from equipment
             elif user_input.char == 'r':
                 chosen_equip = inventory_menu(
-                    'Choose an item to drop, esc to cancel\n', equipment)
+                    'Choose an item to drop, esc to cancel\n', game.equipment)
                 if chosen_equip is not 'cancel':
                     chosen_equip.drop()
 
@@ -1484,59 +3024,104 @@ def get_notable_feature(equip):
     return f'{notable_feature}: {stats[notable_feature]}'
 
 
-def menu(header, options, width):
-    """Creates a menu screen which is displayed over the main game
-    Returns the index of the option selected
+def pooled_console(width, height):
+    """Takes a free off-screen console of this size from the pool,
+    making a new one only if none are free"""
+
+    free = console_pool.get((width, height))
+    if free:
+        return free.pop()
+    return tdl.Console(width, height)
+
+
+def release_console(window):
+    """Returns a console taken with pooled_console() to the pool"""
+
+    console_pool.setdefault((window.width, window.height), []).append(window)
+
+
+def render_menu(header, lines, width):
+    """Draws a menu onto an off-screen console and returns it
+    A menu drawn before with the same header, lines and width is reused as is
     """
 
-    if len(options) > 26:
-        raise ValueError('Cannot have more than 26 options')
+    key = (header, lines, width)
+    window = menu_cache.get(key)
+    if window is not None:
+        menu_cache.move_to_end(key)
+        return window
 
     header_wrapped = []
     for header_line in header.splitlines():
         header_wrapped.extend(textwrap.wrap(header_line, width - 2))
     header_height = len(header_wrapped)
-    height = len(options) + header_height + 2
+    height = len(lines) + header_height + 2
 
-    window = tdl.Console(width, height)
-    window.draw_rect(0, 0, width, height, None, bg=colors.dark_gray)
+    window = pooled_console(width, height)
+    # Blank every cell, pooled consoles still hold their last menu
+    window.draw_rect(0, 0, width, height, ' ', bg=colors.dark_gray)
     for i, line in enumerate(header_wrapped):
         window.draw_str(1, 0 + i, header_wrapped[i], fg=colors.light_gray)
 
     y = header_height + 1
+    for text in lines:
+        window.draw_str(0, y, text, fg=colors.white, bg=None)
+        y += 1
+
+    menu_cache[key] = window
+    if len(menu_cache) > menu_cache_size:
+        _, old_window = menu_cache.popitem(last=False)
+        release_console(old_window)
+    return window
+
+
+def menu(header, options, width):
+    """Creates a menu screen which is displayed over the main game
+    Returns the index of the option selected
+    """
+
+    if len(options) > 26:
+        raise ValueError('Cannot have more than 26 options')
+
     letter_index = ord('a')
+    lines = []
     try:
-        if options[0] == equipment[0].name:
+        if options[0] == game.equipment[0].name:
             for i, option in enumerate(options):
-                text = f'({chr(letter_index)}) {option} ' \
-                       f'({get_notable_feature(equipment[i])})'
-                window.draw_str(0, y, text, fg=colors.white, bg=None)
-                y += 1
+                lines.append(f'({chr(letter_index)}) {option} '
+                             f'({get_notable_feature(game.equipment[i])})')
                 letter_index += 1
         else:
             for option in options:
-                text = f'({chr(letter_index)}) {option}'
-                window.draw_str(0, y, text, fg=colors.white, bg=None)
-                y += 1
+                lines.append(f'({chr(letter_index)}) {option}')
                 letter_index += 1
     except IndexError:
+        lines = []
+        letter_index = ord('a')
         for option in options:
-            text = f'({chr(letter_index)}) {option}'
-            window.draw_str(0, y, text, fg=colors.white, bg=None)
-            y += 1
+            lines.append(f'({chr(letter_index)}) {option}')
             letter_index += 1
 
-    x = screen_width // 2 - width // 2
-    y = screen_height // 2 - height // 2
-    root.blit(window, x, y, width, height, 0, 0)
+    # The menu covers the screen, so the next frame is drawn in full
+    game.last_frame.clear()
+    if game.session is not None:
+        game.session.send(clear_screen +
+                          '\r\n'.join(header.splitlines() + [''] + lines))
+    else:
+        window = render_menu(header, tuple(lines), width)
+        height = window.height
+
+        x = screen_width // 2 - width // 2
+        y = screen_height // 2 - height // 2
+        root.blit(window, x, y, width, height, 0, 0)
 
-    tdl.flush()
+        tdl.flush()
 
     # This usually catches a text type event
-    key = tdl.event.key_wait()
+    key = wait_key()
     # So we wait for the next non-text event
     while key.key == 'TEXT':
-        key = tdl.event.key_wait()
+        key = wait_key()
     key_char = key.char
 
     if len(key_char) != 1:
@@ -1557,13 +3142,23 @@ def message(new_msg, color=colors.white):
     color -(tuple)- rgb value to display for this message
     """
 
-    new_msg_lines = textwrap.wrap(new_msg, panel_width)
+    game.events.emit(Text(new_msg, color))
 
-    for line in new_msg_lines:
-        if len(game_msgs) == msg_height:
-            del game_msgs[0]
 
-        game_msgs.append((line, color))
+def message_lines(height):
+    """Returns the newest `height` lines of the message log as (text, color)
+    Only the messages that are shown ever get formatted and wrapped
+    """
+
+    shown = []
+    for entry in reversed(game.game_msgs):
+        if entry[1] is None:
+            entry[1] = [(line, color) for text, color in entry[0].lines()
+                        for line in textwrap.wrap(text, panel_width)]
+        shown[:0] = entry[1]
+        if len(shown) >= height:
+            break
+    return shown[-height:]
 
 
 # def target_tile(max_range=None):
@@ -1607,15 +3202,13 @@ def message(new_msg, color=colors.white):
 
 
 def player_move(dx, dy):
-    global fov_recompute
-
     # Where are we trying to move?
-    x = player.x + dx
-    y = player.y + dy
+    x = game.player.x + dx
+    y = game.player.y + dy
 
     # Is there a fighter there to target?
     target = None
-    for obj in objects:
+    for obj in game.objects:
         if obj.fighter and obj.x == x and obj.y == y:
             target = obj
             break
@@ -1623,16 +3216,192 @@ def player_move(dx, dy):
     if target is not None:
         # If target is your ally, swap places with it
         if target.name == 'Your ally':
-            player.x, target.x = target.x, player.x
-            player.y, target.y = target.y, player.y
+            x, y = game.player.x, game.player.y
+            game.player.place(target.x, target.y)
+            target.place(x, y)
         # Attack otherwise
         else:
-            player.fighter.attack(target)
+            game.player.fighter.attack(target)
 
     # Move there if there's no target
     else:
-        player.move(dx, dy)
-        fov_recompute = True
+        game.player.move(dx, dy)
+        game.fov_recompute = True
+
+
+# # Travel # #
+# Auto-explore and travel to the stairs walk the player downhill on a
+# distance map over the explored, walkable tiles, and resting stays put.
+# play_turn() keeps taking their turns without drawing or reading keys until
+# travel_step() stops.
+
+
+# What travel says when it starts out already at its goal
+travel_already_there = {
+    'explore': 'There is nothing more to see from here',
+    'stairs': 'You are already on the stairs'
+}
+
+
+def travel_goals(goal):
+    """Returns the tiles the named travel is headed for as a bool array"""
+
+    fld = game.field
+    if goal == 'stairs':
+        goals = np.zeros((fld.width, fld.height), dtype=bool)
+        goals[game.stairs.x, game.stairs.y] = True
+        return goals & fld.explored
+
+    # Explored floor next to a tile that hasn't been seen yet
+    padded = np.pad(~fld.explored, 1)
+    unseen_near = (padded[:-2, 1:-1] | padded[2:, 1:-1] |
+                   padded[1:-1, :-2] | padded[1:-1, 2:])
+    return unseen_near & fld.explored & ~fld.blocked
+
+
+def hostile_in_view(visible):
+    return bool(WorldView().near(game.player.x, game.player.y,
+                                 factions=('monster',), sight=visible))
+
+
+def rested():
+    fighter = game.player.fighter
+    return fighter.hp >= fighter.max_hp and fighter.mp >= fighter.max_mp
+
+
+def start_travel(goal):
+    """Starts travelling to `goal`: 'explore', 'stairs', or 'rest' to wait
+    until HP and MP are full
+    Returns 'no-turn' if the first turn could not be taken
+    """
+
+    game.events.dispatch()
+    if hostile_in_view(update_fov()):
+        message('Not with enemies around!', colors.light_red)
+        return 'no-turn'
+    if goal == 'stairs' and not game.field.explored[game.stairs.x,
+                                                    game.stairs.y]:
+        message("You haven't found the stairs yet", colors.white)
+        return 'no-turn'
+    if goal == 'rest' and rested():
+        message('You are already well rested', colors.white)
+        return 'no-turn'
+
+    game.travel = goal
+    game.travel_msgs = game.msg_count
+    game.travel_turns = 0
+    if not travel_step():
+        return 'no-turn'
+
+
+def travel_step():
+    """Takes the next turn of the travel in progress
+    Returns False, and stops travelling, once it arrived or something needs
+    the player's attention: a new message, an enemy in view or death
+    """
+
+    visible = update_fov()
+    game.events.dispatch()
+    if game.game_state != 'play' or game.msg_count != game.travel_msgs \
+            or hostile_in_view(visible) or game.travel_turns >= travel_limit:
+        game.travel = None
+        return False
+
+    # Resting recovers what a calm moment between floors would, every
+    # rest_interval turns
+    if game.travel == 'rest':
+        if rested():
+            game.travel = None
+            return False
+        game.travel_turns += 1
+        if game.travel_turns % rest_interval == 0:
+            regen_hp, regen_mp = player_regen()
+            game.player.fighter.heal(health=regen_hp, mana=regen_mp)
+        return True
+
+    goals = travel_goals(game.travel)
+    x, y = game.player.x, game.player.y
+    if goals[x, y]:
+        if game.travel_turns == 0:
+            message(travel_already_there[game.travel], colors.white)
+        game.travel = None
+        return False
+
+    # Allies swap places with the player, other blocking entities are walked
+    # around, never into
+    fld = game.field
+    occupied = fld.occupants.copy()
+    for obj in game.objects:
+        if obj.fighter and obj.occupying is fld and faction(obj) == 'ally':
+            occupied[obj.x, obj.y] -= 1
+    open_floor = fld.explored & ~fld.blocked
+    moves = ((0, -1), (0, 1), (-1, 0), (1, 0))
+    dist = distance_map(open_floor & (occupied <= 0), goals)
+    steps = [(dist[x + dx, y + dy], dx, dy) for dx, dy in moves
+             if dist[x + dx, y + dy] >= 0]
+    if not steps:
+        if game.travel == 'explore' and not goals.any():
+            message('There is nothing left to explore here', colors.white)
+        elif any(distance_map(open_floor, goals)[x + dx, y + dy] >= 0
+                 for dx, dy in moves):
+            message('Something is in the way', colors.white)
+        else:
+            message("You don't know a way there", colors.white)
+        game.travel = None
+        return False
+
+    _, dx, dy = min(steps)
+    player_move(dx, dy)
+    game.travel_turns += 1
+    return True
+
+
+class Hud:
+    """Keeps track of which widgets of the HUD panel need redrawing
+
+    The player's Fighter, equipment, level ups and stairs mark the widgets
+    showing what they changed through mark()
+    """
+
+    def __init__(self):
+        self.dirty = set(hud_layout)
+
+    def mark(self, *widgets):
+        self.dirty.update(widgets)
+
+
+def minimap_scale(fld):
+    """Returns how many tiles across each cell of the minimap stands for"""
+
+    return max(minimap_block, -(-fld.width // minimap_width),
+               -(-fld.height // minimap_height))
+
+
+def render_minimap(block):
+    """Draws the explored floor, its stairs and the player on the `panel`,
+    folding each `block` by `block` square of tiles into one cell"""
+
+    fld = game.field
+    width, height = -(-fld.width // block), -(-fld.height // block)
+
+    # Pad the floor out to whole blocks, then a cell shows ground if any of
+    # its tiles is explored ground, or else wall if any is explored wall
+    padded = np.zeros((2, width * block, height * block), dtype=bool)
+    padded[0, :fld.width, :fld.height] = fld.explored & ~fld.blocked
+    padded[1, :fld.width, :fld.height] = fld.explored & fld.blocked
+    ground, wall = padded.reshape(2, width, block, height, block) \
+        .any(axis=(2, 4))
+    state = ground + 2 * (wall & ~ground)
+
+    panel.draw_rect(minimap_x, minimap_y, minimap_width, minimap_height,
+                    ' ', fg=colors.white, bg=colors.black)
+    panel.bg[minimap_x:minimap_x + width, minimap_y:minimap_y + height] = \
+        colors.packed_palette[colors.tile_states[state]]
+
+    for obj in (game.stairs, game.upstairs, game.player):
+        if obj is not None and fld.explored[obj.x, obj.y]:
+            panel.draw_char(minimap_x + obj.x // block,
+                            minimap_y + obj.y // block, obj.char, obj.color)
 
 
 def render_bar(x, y, total_width, name, value, maximum,
@@ -1640,13 +3409,20 @@ def render_bar(x, y, total_width, name, value, maximum,
     """Render a bar which visually represents some stat
     and draw it to the `panel` HUD element"""
 
-    bar = int(float(value) / maximum * total_width)
+    fill = min(max(float(value) / maximum * total_width, 0), total_width)
+    bar = int(fill)
 
     panel.draw_rect(x, y, total_width, 1, None, bg=bg_color)
 
     if bar > 0:
         panel.draw_rect(x, y, bar, 1, None, bg=bar_color)
 
+    # Shade the cell at the end of the bar by how much of it is filled
+    if bar < total_width and fill > bar:
+        shades = colors.gradient(bg_color, bar_color, bar_shades)
+        panel.draw_char(x + bar, y, None, fg=None,
+                        bg=shades[int((fill - bar) * (bar_shades - 1))])
+
     text = f'{name}: {str(value)} / {str(maximum)}'
     x_centered = x + (total_width - len(text)) // 2
     panel.draw_str(x_centered, y, text, fg=text_color, bg=None)
@@ -1662,120 +3438,1058 @@ def render_stat(x, y, name, base_stat, stat):
     panel.draw_str(x + 4, y, str(stat), bg=None, fg=color)
 
 
+def update_fov():
+    """Recomputes the player's FOV if it is out of date and marks what they
+    can see as explored
+
+    Returns the visible tiles as a bool array indexed [x, y], which is kept
+    until the next recompute, so treat it as read only
+    """
+
+    if game.fov_recompute:
+        game.fov_recompute = False
+        game.visible_tiles, game.visible = sight_from(game.player.x,
+                                                      game.player.y,
+                                                      fov_radius)
+        game.scheduler.wake(game.visible_tiles)
+
+        seen = game.visible & ~game.field.explored
+        if seen.any():
+            game.field.explored |= seen
+            game.explored_changes += 1
+    return game.visible
+
+
+def sight_from(x, y, radius):
+    """Returns the tiles in line of sight of (x, y) and within `radius`, as
+    a set of (x, y) and as a bool array indexed [x, y]
+    """
+
+    tiles, window, mask = sight_window(x, y, radius)
+    visible = np.zeros((game.field.width, game.field.height), dtype=bool)
+    visible[window] = mask
+    return tiles, visible
+
+
+def sight_window(x, y, radius):
+    """Returns what sight_from() sees, with the mask cut down to the window
+    of the field around (x, y) it fits in, as a pair of slices
+
+    The last sight_cache_size results on each floor are kept in its
+    sight_cache, so walking back over a tile costs no shadowcast. Treat what
+    comes back as read only.
+    """
+
+    fld = game.field
+    key = (x, y, radius)
+    seen = fld.sight_cache.get(key)
+    if seen is None:
+        # Cast over the window the tiles fit in, from the transparency of
+        # its tiles. A whole floor's worth per tile would add up on big
+        # floors.
+        r = radius + 1
+        x1, y1 = max(x - r, 0), max(y - r, 0)
+        window = (slice(x1, min(x + r + 1, fld.width)),
+                  slice(y1, min(y + r + 1, fld.height)))
+        mask = tcod.map.compute_fov(~fld.block_sight[window],
+                                    (x - x1, y - y1), radius,
+                                    fov_light_walls, fov_algo)
+        xs, ys = np.nonzero(mask)
+        tiles = frozenset(zip((xs + x1).tolist(), (ys + y1).tolist()))
+        seen = tiles, window, mask
+
+        fld.sight_cache[key] = seen
+        if len(fld.sight_cache) > sight_cache_size:
+            fld.sight_cache.popitem(last=False)
+    else:
+        fld.sight_cache.move_to_end(key)
+    return seen
+
+
+def glow(x, y, radius):
+    """Returns the light a source at (x, y) spreads, fading out `radius`
+    tiles away, as a window of the field and the light on each of its tiles
+    Kept in the floor's light_cache like sight_window()
+    """
+
+    fld = game.field
+    key = (x, y, radius)
+    lit = fld.light_cache.get(key)
+    if lit is None:
+        _, window, mask = sight_window(x, y, radius)
+        dx, dy = np.ogrid[window[0].start - x:window[0].stop - x,
+                          window[1].start - y:window[1].stop - y]
+        fade = 1 - np.sqrt(dx ** 2 + dy ** 2) / (radius + 1)
+        lit = window, np.where(mask, np.rint(np.maximum(fade, 0) * 256),
+                               0).astype(np.int32)
+
+        fld.light_cache[key] = lit
+        if len(fld.light_cache) > sight_cache_size:
+            fld.light_cache.popitem(last=False)
+    else:
+        fld.light_cache.move_to_end(key)
+    return lit
+
+
+class Flash:
+    """The light a spell leaves where it went off, which lasts
+    spell_light_turns turns"""
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+        self.light = spell_light
+        self.turns = spell_light_turns
+
+
+def update_light():
+    """Brings the floor's light up to date with the light sources on it:
+    entities, the items the player has equipped and spell flashes.
+    Only the glow of sources which moved, came or went is taken away and
+    added again.
+    Returns the light level of each tile, see colors.lit_tiles
+    """
+
+    fld = game.field
+    sources = {obj: glow(obj.x, obj.y, obj.light)
+               for obj in game.objects if obj.light}
+    # Equipped items glow from the player's tile
+    for item in game.equipment:
+        if item.light and item.equipment.is_equipped:
+            sources[item] = glow(game.player.x, game.player.y, item.light)
+    for flash in game.flashes:
+        sources[flash] = glow(flash.x, flash.y, flash.light)
+    for obj, (window, light) in fld.lights.items():
+        if sources.get(obj) is not fld.lights[obj]:
+            fld.light[window] -= light
+    for obj, lit in sources.items():
+        if fld.lights.get(obj) is not lit:
+            window, light = lit
+            fld.light[window] += light
+    fld.lights = sources
+
+    return np.minimum(fld.light * colors.light_steps // 256,
+                      colors.light_steps - 1)
+
+
 def render_all():
-    """render everything to the screen"""
-
-    global fov_recompute, visible_tiles
-
-    # Write the background
-    root.blit(background)
-
-    if fov_recompute:
-        fov_recompute = False
-        visible_tiles = tdl.map.quickFOV(player.x, player.y,
-                                         is_visible_tile,
-                                         fov=fov_algo,
-                                         radius=fov_radius,
-                                         lightWalls=fov_light_walls)
-
-    for y in range(field_height):
-        for x in range(field_width):
-
-            visible = (x, y) in visible_tiles
-            wall = field[x][y].block_sight
-
-            # If this tile is not in the player's FOV
-            if not visible:
-                # Display it as dark if they've been there
-                if field[x][y].explored:
-                    if wall:
-                        con.draw_char(x, y, None, fg=None, bg=c_dark_wall)
-                    else:
-                        con.draw_char(x, y, None, fg=None, bg=c_dark_gnd)
-                # # Uncomment this block to see the map outline
-                # if wall:
-                #     con.draw_char(x, y, None, fg=None, bg=c_dark_wall)
-                # else:
-                #     con.draw_char(x, y, None, fg=None, bg=c_dark_gnd)
-
-            # If this tile is in the player;s FOV
-            else:
-                # Display it as a lit area
-                if wall:
-                    con.draw_char(x, y, None, fg=None, bg=c_light_wall)
+    """Draws what changed since the current game's last frame onto the
+    canvases, then presents the frame
+
+    The map redraws the tiles whose lighting changed and the tiles an
+    entity arrived at or left. The message log redraws when a message came
+    in, and each HUD widget when a stat it shows changed.
+    """
+
+    claim_canvases()
+    drawn = game.drawn
+    visible = update_fov()
+
+    # Tiles outside the player's FOV are dark if they've been there,
+    # tiles inside it are shaded by how much light falls on them
+    state = game.field.explored * (1 + game.field.block_sight)
+    bg = colors.tile_states[state]
+    walls = game.field.block_sight[visible].astype(np.intp)
+    bg[visible] = colors.lit_tiles[walls, update_light()[visible]]
+
+    # Visible behemoths light up the open, explored tiles around them
+    behemoths = [obj for obj in game.objects
+                 if isinstance(obj.ai, Behemoth) and visible[obj.x, obj.y]]
+    if behemoths:
+        open_tiles = game.field.explored & ~blocking_map()
+        for obj in behemoths:
+            window, zone = obj.ai.danger_zone()
+            bg[window][zone & open_tiles[window]] = \
+                colors.palette_index['light_flame']
+
+    # What shows on each tile that has an entity, the player on top
+    marks = {}
+    for obj in game.objects:
+        if obj != game.player and obj.shown():
+            marks[obj.x, obj.y] = obj.char, obj.color
+    if game.player.shown():
+        marks[game.player.x, game.player.y] = \
+            game.player.char, game.player.color
+
+    last_bg, last_marks = drawn.get('con', (None, {}))
+    if last_bg is None:
+        dirty = np.ones(bg.shape, dtype=bool)
+    else:
+        dirty = bg != last_bg
+    for pos in marks.keys() | last_marks.keys():
+        if marks.get(pos) != last_marks.get(pos):
+            dirty[pos] = True
+
+    con.ch[dirty] = ord(' ')
+    con.fg[dirty] = con.default_fg
+    con.bg[dirty] = colors.packed_palette[bg[dirty]]
+    for (x, y), (char, color) in marks.items():
+        if dirty[x, y]:
+            con.draw_char(x, y, char, color)
+    drawn['con'] = bg, marks
+
+    # Render messages
+    game.events.dispatch()
+    if drawn.get('messages') != game.msg_count:
+        messages.clear()
+        y = 0
+        for (line, color) in message_lines(msg_height):
+            messages.draw_str(0, y, line, bg=None, fg=color)
+            y += 1
+        drawn['messages'] = game.msg_count
+
+    # Re-render the stats displays that changed
+    if game.hud.dirty:
+        render_panel(game.hud.dirty)
+        game.hud.dirty.clear()
+
+    # Redraw the minimap when more of the floor was seen or the player
+    # stepped into another of its cells, or died
+    block = minimap_scale(game.field)
+    minimap = (game.dungeon_level, game.explored_changes,
+               game.player.x // block, game.player.y // block,
+               game.player.char)
+    if drawn.get('minimap') != minimap:
+        render_minimap(block)
+        drawn['minimap'] = minimap
+
+    present()
+
+
+def render_panel(widgets):
+    """Redraws the named HUD widgets on the `panel`, see hud_layout"""
+
+    for widget in widgets:
+        # Wipe the widget's spot before drawing it again
+        x, y, width = hud_layout[widget]
+        panel.draw_rect(x, y, width, 1, ' ', fg=colors.white, bg=colors.black)
+
+        if widget == 'hp':
+            # Player's HP
+            render_bar(x, y, width, 'HP',
+                       game.player.fighter.hp, game.player.fighter.max_hp,
+                       colors.light_red, colors.darker_red, colors.white)
+        elif widget == 'mp':
+            # Player's MP
+            render_bar(x, y, width, 'MP',
+                       game.player.fighter.mp, game.player.fighter.max_mp,
+                       colors.light_blue, colors.darker_red, colors.white)
+        elif widget == 'floor':
+            # Dungeon Level
+            panel.draw_str(x, y, f'Floor: {game.dungeon_level}',
+                           bg=colors.white, fg=colors.black)
+        elif widget == 'str':
+            render_stat(x, y, 'STR', game.player.fighter.base_power,
+                        game.player.fighter.power)
+        elif widget == 'mag':
+            render_stat(x, y, 'MAG', game.player.fighter.base_mag,
+                        game.player.fighter.mag)
+        elif widget == 'def':
+            render_stat(x, y, 'DEF', game.player.fighter.base_defense,
+                        game.player.fighter.defense)
+        elif widget == 'reg':
+            render_stat(x, y, 'REG', game.player.fighter.base_regen,
+                        game.player.fighter.regen)
+        elif widget == 'xp':
+            # Player Level & XP
+            render_bar(x, y, width, f'Lv{game.player.level}',
+                       int(game.player.fighter.xp),
+                       level_up_base + game.player.level * level_up_factor,
+                       colors.light_violet, colors.desaturated_violet,
+                       colors.white)
+
+
+# # # # # # # # # # # # # # # # # # # #
+#   Canvases and Renderers
+# # # # # # # # # # # # # # # # # # # #
+# render_all() draws each frame onto the con, messages and panel canvases.
+# present() then works out once which cells changed since the game's last
+# frame and hands them to every renderer the game has, through
+# draw(changes, full). `changes` maps each region name to its changed Cells,
+# and `full` is true when they are every cell of the screen.
+
+
+Cells = namedtuple('Cells', ['x', 'y', 'ch', 'fg', 'bg'])
+
+
+def packed_color(color, default):
+    # tdl style colors: Ellipsis for the default, an rgb tuple or 0xRRGGBB
+    if color is Ellipsis:
+        return default
+    if isinstance(color, tuple):
+        return color[0] << 16 | color[1] << 8 | color[2]
+    return int(color)
+
+
+class Canvas:
+    """An off-screen console kept in numpy arrays indexed [x, y]. It draws
+    like a tdl console, where a char, fg or bg of None is left as it was.
+
+    Arrays:
+    ch -- character codes
+    fg, bg -- colors packed as 0xRRGGBB
+    """
+
+    default_fg = 0xFFFFFF
+    default_bg = 0x000000
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.ch = np.full((width, height), ord(' '), dtype=np.int32)
+        self.fg = np.full((width, height), self.default_fg, dtype=np.int32)
+        self.bg = np.full((width, height), self.default_bg, dtype=np.int32)
+
+    def draw_rect(self, x, y, width, height, string, fg=Ellipsis, bg=Ellipsis):
+        window = slice(x, x + width), slice(y, y + height)
+        if string is not None:
+            self.ch[window] = ord(string)
+        if fg is not None:
+            self.fg[window] = packed_color(fg, self.default_fg)
+        if bg is not None:
+            self.bg[window] = packed_color(bg, self.default_bg)
+
+    def draw_char(self, x, y, char, fg=Ellipsis, bg=Ellipsis):
+        self.draw_rect(x, y, 1, 1, char, fg, bg)
+
+    def draw_str(self, x, y, string, fg=Ellipsis, bg=Ellipsis):
+        # Whatever runs off the edge is cut off
+        string = string[max(-x, 0):self.width - x]
+        x = max(x, 0)
+        if not string or not 0 <= y < self.height:
+            return
+
+        window = slice(x, x + len(string)), y
+        self.ch[window] = [ord(char) for char in string]
+        if fg is not None:
+            self.fg[window] = packed_color(fg, self.default_fg)
+        if bg is not None:
+            self.bg[window] = packed_color(bg, self.default_bg)
+
+    def clear(self, fg=Ellipsis, bg=Ellipsis):
+        self.draw_rect(0, 0, self.width, self.height, ' ', fg, bg)
+
+    def copy(self):
+        canvas = Canvas(self.width, self.height)
+        canvas.ch[:] = self.ch
+        canvas.fg[:] = self.fg
+        canvas.bg[:] = self.bg
+        return canvas
+
+    def changes(self, last=None):
+        """Returns the Cells that differ from the canvas `last`, or all of
+        them without one"""
+
+        if last is None:
+            changed = np.ones((self.width, self.height), dtype=bool)
+        else:
+            changed = (self.ch != last.ch) | (self.fg != last.fg) | \
+                (self.bg != last.bg)
+        xs, ys = np.nonzero(changed)
+        return Cells(xs, ys, self.ch[changed], self.fg[changed],
+                     self.bg[changed])
+
+
+def claim_canvases():
+    """Puts the current game's last frame back on the canvases if another
+    game drew on them since, so render_all() can draw only what changed"""
+
+    global canvas_owner
+
+    if canvas_owner is game:
+        return
+    canvas_owner = game
+    if not game.last_frame:
+        game.drawn.clear()
+        panel.clear(fg=colors.white, bg=colors.black)
+        game.hud.mark(*hud_layout)
+        return
+    for name, _, _, canvas in regions:
+        last = game.last_frame[name]
+        canvas.ch[:] = last.ch
+        canvas.fg[:] = last.fg
+        canvas.bg[:] = last.bg
+
+
+def present():
+    """Shows what changed on the canvases since the current game's last
+    frame through all of its renderers"""
+
+    full = not game.last_frame
+    changes = {}
+    for name, _, _, canvas in regions:
+        changes[name] = canvas.changes(game.last_frame.get(name))
+        game.last_frame[name] = canvas.copy()
+
+    for renderer in game.renderers:
+        renderer.draw(changes, full)
+
+
+class TdlRenderer:
+    """Shows the canvases in the tdl window, redrawing only changed cells"""
+
+    def __init__(self):
+        self.consoles = {name: tdl.Console(canvas.width, canvas.height)
+                         for name, _, _, canvas in regions}
+
+    def draw(self, changes, full):
+        # Write the background
+        if full:
+            root.blit(background)
+
+        for name, x, y, canvas in regions:
+            if not full and not len(changes[name].x):
+                continue
+            console = self.consoles[name]
+            cells = zip(*(column.tolist() for column in changes[name]))
+            for cell_x, cell_y, ch, fg, bg in cells:
+                console.draw_char(cell_x, cell_y, chr(ch), fg, bg)
+            root.blit(console, x, y, canvas.width, canvas.height, 0, 0)
+
+
+class AnsiRenderer:
+    """Draws the canvases on an ANSI terminal with 24-bit colors
+
+    Only changed cells are written, in screen order. Neighbouring cells on a
+    row go out as one run with no cursor movement between them, short hops
+    along a row use a relative move, and colors are only set when they
+    differ from the last cell written.
+
+    Keyword Arguments:
+    write -(function)- called with the text of each frame
+    """
+
+    def __init__(self, write):
+        self.write = write
+
+    def draw(self, changes, full):
+        xs, ys, chars, fgs, bgs = [], [], [], [], []
+        for name, x, y, _ in regions:
+            cells = changes[name]
+            xs.append(cells.x + x)
+            ys.append(cells.y + y)
+            chars.append(cells.ch)
+            fgs.append(cells.fg)
+            bgs.append(cells.bg)
+
+        columns = [np.concatenate(column)
+                   for column in (xs, ys, chars, fgs, bgs)]
+        order = np.lexsort((columns[0], columns[1]))
+        cells = zip(*(column[order].tolist() for column in columns))
+        out = []
+        if full:
+            # Hide the cursor and start from a blank screen
+            out.append('\x1b[?25l' + clear_screen)
+
+        cursor = None
+        colors_set = None
+        for x, y, ch, fg, bg in cells:
+            if cursor is None or cursor[1] != y or cursor[0] > x:
+                out.append(f'\x1b[{y + 1};{x + 1}H')
+            elif cursor[0] < x:
+                out.append(f'\x1b[{x - cursor[0]}C')
+
+            if (fg, bg) != colors_set:
+                out.append(f'\x1b[38;2;{fg >> 16};{fg >> 8 & 255};{fg & 255}'
+                           f';48;2;{bg >> 16};{bg >> 8 & 255};{bg & 255}m')
+                colors_set = fg, bg
+
+            out.append(chr(ch))
+            cursor = x + 1, y
+
+        if out:
+            self.write(''.join(out) + '\x1b[0m')
+
+
+# # Spectators # #
+# Every message is a kind byte, then the payload length as a little endian
+# uint32, then the payload:
+#   b'L' layout, JSON list of [name, x, y, width, height] for each region
+#   b'F' full frame, or b'D' the changes since the last frame, compressed
+#        with zlib. For each region in layout order: the region number as a
+#        uint8, the number of cells as a uint32, then that many spectator_cell
+
+
+spectator_cell = np.dtype([('x', 'u1'), ('y', 'u1'), ('ch', '<u2'),
+                           ('fg', '<u4'), ('bg', '<u4')])
+
+
+def encode_frame(kind, changes):
+    blocks = []
+    for number, (name, _, _, _) in enumerate(regions):
+        cells = changes[name]
+        packed = np.empty(len(cells.x), dtype=spectator_cell)
+        for column_name, column in zip(Cells._fields, cells):
+            packed[column_name] = column
+        blocks.append(np.array([number], dtype='u1').tobytes())
+        blocks.append(np.array([len(packed)], dtype='<u4').tobytes())
+        blocks.append(packed.tobytes())
+    return encode_message(kind, zlib.compress(b''.join(blocks), 1))
+
+
+def encode_message(kind, payload):
+    return kind + len(payload).to_bytes(4, 'little') + payload
+
+
+class Spectators:
+    """Streams a game to any number of watchers on a local TCP port
+
+    A watcher is sent the layout and a full frame when it connects, then the
+    changed cells of every frame. Each frame is encoded once and the same
+    bytes are queued for every watcher. Watchers that fall more than
+    spectator_backlog bytes behind are dropped.
+
+    Watchers are let in and sent what is queued on every draw() and every
+    poll(), which wait_key() calls while the player is thinking.
+    """
+
+    def __init__(self, port):
+        self.listener = socket.create_server(('127.0.0.1', port))
+        self.listener.setblocking(False)
+        # socket -> bytes still to send
+        self.watchers = {}
+
+    def draw(self, changes, full):
+        if self.watchers:
+            frame = encode_frame(b'F' if full else b'D', changes)
+            for outbox in self.watchers.values():
+                outbox += frame
+        self.poll()
+
+    def poll(self):
+        # Newcomers start from the frame last drawn
+        while True:
+            try:
+                watcher, _ = self.listener.accept()
+            except BlockingIOError:
+                break
+            watcher.setblocking(False)
+            layout = json.dumps([[name, x, y, canvas.width, canvas.height]
+                                 for name, x, y, canvas in regions])
+            full = {name: game.last_frame.get(name, canvas).changes()
+                    for name, _, _, canvas in regions}
+            self.watchers[watcher] = bytearray(
+                encode_message(b'L', layout.encode()) +
+                encode_frame(b'F', full))
+
+        self.flush()
+
+    def flush(self):
+        for watcher, outbox in list(self.watchers.items()):
+            try:
+                if outbox:
+                    del outbox[:watcher.send(outbox)]
+            except BlockingIOError:
+                pass
+            except OSError:
+                # Hung up
+                self.drop(watcher)
+                continue
+            if len(outbox) > spectator_backlog:
+                self.drop(watcher)
+
+    def drop(self, watcher):
+        del self.watchers[watcher]
+        watcher.close()
+
+
+# # # # # # # # # # # # # # # # # # # #
+#   Games and Sessions
+# # # # # # # # # # # # # # # # # # # #
+# Everything that changes during play lives on a Game. Game code reaches the
+# game being played through the module level `game`, so one process can host
+# many games by pointing `game` at each in turn.
+
+
+class Game:
+    """The state of one game in progress
+
+    Keyword Arguments:
+    session -(Session)- the remote player, None when playing in the tdl window
+    """
+
+    def __init__(self, session=None):
+        self.session = session
+
+        # The player, whose stats show on the HUD
+        self.hud = Hud()
+        self.player = Entity(
+            0, 0, '@', 'player', colors.white, blocks=True,
+            fighter=Fighter(hp=50, defense=1, power=5, xp=0,
+                            mp=15, mag=5, regen=1, death_func=player_death),
+            light=fov_radius)
+        self.player.fighter.observer = self.hud.mark
+        self.player.spells = []
+        self.player.level = 1
+        self.equipment = []
+        self.inventory = []
+        self.player_action = None
+        self.game_state = 'play'
+        # Where the player is travelling to, see start_travel()
+        self.travel = None
+        self.travel_msgs = 0
+        self.travel_turns = 0
+        # Level up choices taken so far
+        self.adv_hp_count = 0
+        self.adv_mp_count = 0
+        self.adv_str_count = 0
+        self.adv_mag_count = 0
+
+        # The current floor, filled in by make_field()
+        self.dungeon_level = 1
+        self.field = None
+        self.floor_report = None
+        self.objects = []
+        self.stairs = None
+        self.upstairs = None
+        self.scheduler = None
+        # Spell light on the floor, see Flash
+        self.flashes = []
+        self.visible_tiles = set()
+        self.visible = None
+        self.fov_recompute = True
+        # Bumped whenever more of a floor is explored, for the minimap
+        self.explored_changes = 0
+
+        # Where frames are shown, the last frame of each region, and what
+        # render_all() drew it from
+        self.renderers = []
+        self.last_frame = {}
+        self.drawn = {}
+
+        # Visited floors
+        self.floor_cache = OrderedDict()
+        self.spilled_floors = {}
+        self.floor_dir = tempfile.TemporaryDirectory(prefix='giraffelike-')
+
+        # Idle work and telemetry
+        self.idle_jobs = deque()
+        self.next_floor = None
+        self.telemetry = []
+
+        # Game events, read by the message log and optionally by telemetry
+        # and replay
+        # [event, its wrapped lines or None until first drawn]
+        self.game_msgs = deque(maxlen=msg_height)
+        self.msg_count = 0
+        self.turn_events = Counter()
+        self.events = EventBus()
+        self.events.subscribe(log_message)
+        if telemetry_path is not None:
+            self.events.subscribe(count_event)
+        self.replay_file = None
+        if replay_path is not None:
+            self.replay_file = open(replay_path, 'a')
+            self.events.subscribe(record_replay)
+
+    def close(self):
+        """Deletes the spilled floors and closes the replay file"""
+
+        self.floor_dir.cleanup()
+        if self.replay_file is not None:
+            self.replay_file.close()
+
+
+def new_game(session=None, generator=None):
+    """Starts a game on the first floor and makes it the current game
+
+    Keyword Arguments:
+    session -(Session)- the remote player, None when playing in the tdl window
+    generator -(str)- the floor generator for the first floor, random if None
+    """
+
+    global game
+
+    game = Game(session)
+    make_field(generator)
+
+    # Welcome message
+    message('Welcome to the Warehouse, nerd.', colors.red)
+    return game
+
+
+def play_turn(render_time=0):
+    """Reads one command, then lets the monsters act if it took a turn
+    Returns 'exit' when the player quits
+
+    Keyword Arguments:
+    render_time -(float)- seconds spent drawing the frame, for telemetry
+    """
+
+    check_level_up()
+
+    game.player_action = handle_keys()
+
+    # Quit on esc
+    if game.player_action == 'exit':
+        return 'exit'
+
+    # # Actions which only happen after the player acts
+    if game.game_state == 'play' and game.player_action != 'no-turn':
+        end_turn(render_time)
+
+    # Travelling takes its turns in one go, without drawing any of them
+    while game.travel is not None and travel_step():
+        end_turn()
+
+
+def end_turn(render_time=0):
+    """Lets the monsters act after the player took a turn
+
+    Keyword Arguments:
+    render_time -(float)- seconds spent drawing the frame, for telemetry
+    """
+
+    # Monsters' turn
+    turn_start = time.perf_counter()
+    player_regen()
+    game.scheduler.advance(action_delay(game.player))
+
+    # Spell light fades once its turns are up
+    game.flashes = [flash for flash in game.flashes if flash.turns > 0]
+    for flash in game.flashes:
+        flash.turns -= 1
+
+    if telemetry_path is not None:
+        game.events.dispatch()
+        game.telemetry.append({
+            'floor' : game.dungeon_level,
+            'objects' : len(game.objects),
+            'turn_ms' : (time.perf_counter() - turn_start) * 1000,
+            'render_ms' : render_time * 1000,
+            'events' : dict(game.turn_events)
+        })
+        game.turn_events.clear()
+        if len(game.telemetry) >= telemetry_batch:
+            schedule_idle(flush_telemetry())
+
+
+# Terminal input for the keys handle_keys() looks for by name
+terminal_keys = {
+    b'\x1b[A' : 'UP',
+    b'\x1b[B' : 'DOWN',
+    b'\x1b[C' : 'RIGHT',
+    b'\x1b[D' : 'LEFT',
+    b'\x1bOA' : 'UP',
+    b'\x1bOB' : 'DOWN',
+    b'\x1bOC' : 'RIGHT',
+    b'\x1bOD' : 'LEFT',
+    b'\x1b' : 'ESCAPE',
+    b' ' : 'SPACE',
+    # A terminal can't send shift on its own
+    b'g' : 'SHIFT'
+}
+
+
+class Session:
+    """A player connected over a socket, from telnet or a raw mode terminal
+
+    Game code only runs with game_lock held. A session lets go of it whenever
+    it talks to its player, so the other sessions can play in the meantime.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.game = None
+        self.keys = deque()
+
+    def resume(self):
+        global game
+
+        game_lock.acquire()
+        game = self.game
+
+    def send(self, text):
+        game_lock.release()
+        try:
+            self.sock.sendall(text.encode())
+        finally:
+            self.resume()
+
+    def wait_key(self):
+        while not self.keys:
+            # Work on this game's idle jobs until the player types something,
+            # letting the other sessions in between slices
+            poll_spectators()
+            waiting = select.select([self.sock], [], [], 0)[0]
+            if not waiting and run_idle_slice():
+                game_lock.release()
+                self.resume()
+                continue
+
+            game_lock.release()
+            try:
+                data = self.sock.recv(1024)
+            finally:
+                self.resume()
+            if not data:
+                raise ConnectionResetError('the player hung up')
+            self.read_keys(data)
+
+        return self.keys.popleft()
+
+    def read_keys(self, data):
+        """Turns terminal input into tdl key events"""
+
+        i = 0
+        while i < len(data):
+            # Skip telnet commands
+            if data[i] == 255:
+                if data[i + 1:i + 2] == b'\xfa':
+                    end = data.find(b'\xff\xf0', i)
+                    i = len(data) if end < 0 else end + 2
+                elif data[i + 1:i + 2] in (b'\xfb', b'\xfc', b'\xfd', b'\xfe'):
+                    i += 3
                 else:
-                    con.draw_char(x, y, None, fg=None, bg=c_light_gnd)
+                    i += 2
+                continue
 
-                field[x][y].explored = True
+            if data[i:i + 3] in terminal_keys:
+                key = data[i:i + 3]
+            else:
+                key = data[i:i + 1]
+            i += len(key)
+
+            if key in terminal_keys:
+                name = terminal_keys[key]
+                char = ' ' if name == 'SPACE' else ''
+            elif 32 < key[0] < 127:
+                name = 'CHAR'
+                char = key.decode()
+            else:
+                continue
+            self.keys.append(tdl.event.KeyDown(key=name, char=char))
+
+
+class SessionHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # Ask telnet clients to send every key as it is pressed
+        self.request.sendall(telnet_char_mode)
+
+        session = Session(self.request)
+        session.resume()
+        try:
+            session.game = new_game(session)
+            game.renderers.append(AnsiRenderer(session.send))
+            while True:
+                frame_start = time.perf_counter()
+                render_all()
+                render_time = time.perf_counter() - frame_start
+
+                if play_turn(render_time) == 'exit':
+                    break
+        except OSError:
+            # The player hung up
+            pass
+        finally:
+            if session.game is not None:
+                session.game.close()
+            game_lock.release()
+            # AnsiRenderer hid the cursor and left colors set, so hand the
+            # terminal back clean unless the player is already gone
+            try:
+                self.request.sendall(
+                    ('\x1b[0m\x1b[?25h' + clear_screen).encode())
+            except OSError:
+                pass
 
-    for obj in objects:
-        if obj != player:
-            obj.draw()
-    player.draw()
 
-    # Blit the field `con` to the main screen `root`
-    root.blit(con, 1, 1, screen_width, screen_height, 0, 0)
+def serve(port):
+    """Hosts a separate game for everyone connecting to `port` on this
+    machine, until interrupted"""
 
-    # Clear the GUI `panel`
-    panel.clear(fg=colors.white, bg=colors.black)
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', port),
+                                             SessionHandler)
+    server.daemon_threads = True
+    with server:
+        server.serve_forever()
 
-    # Render messages
-    messages.clear()
-    y = 0
-    for (line, color) in game_msgs:
-        messages.draw_str(0, y, line, bg=None, fg=color)
-        y += 1
 
-    # Blit the message panel to `root`
-    root.blit(messages, field_width + 2, 1)
-    # Re-render the stats displays
+# # Stress test # #
+# stress_test() packs one big floor with thousands of actors and items and
+# times each turn in three parts: the actors' AI, the blocking checks they
+# make, and drawing the frame. Nothing is shown, but every frame is drawn on
+# the canvases as if it were.
 
-    # Monster under mouse
-    # panel.draw_str(1, 0, get_names_under_mouse(),
-    #                bg=None, fg=colors.light_gray)
 
-    # Player's HP
-    render_bar(1, 1, bar_width, 'HP', player.fighter.hp, player.fighter.max_hp,
-               colors.light_red, colors.darker_red, colors.white)
+class Stopwatch:
+    """Wraps a function and adds up the time spent in it"""
 
-    # Player's MP
-    render_bar(1, 3, bar_width, 'MP', player.fighter.mp, player.fighter.max_mp,
-               colors.light_blue, colors.darker_red, colors.white)
+    def __init__(self, func):
+        self.func = func
+        self.elapsed = 0
 
-    # Dungeon Level
-    panel.draw_str(panel_width - 11, panel_height - 2,
-                   f'Floor: {dungeon_level}', bg=colors.white, fg=colors.black)
+    def __call__(self, *args):
+        start = time.perf_counter()
+        try:
+            return self.func(*args)
+        finally:
+            self.elapsed += time.perf_counter() - start
 
-    # STR
-    render_stat(1, 5, 'STR',
-                player.fighter.base_power, player.fighter.power)
 
-    # MAG
-    render_stat(1, 7, 'MAG',
-                player.fighter.base_mag, player.fighter.mag)
+def stress_floor(count):
+    """Starts a game on a cave floor big enough for `count` things, and
+    fills it with them in the shares of stress_mix
+    Returns how many of each kind were placed
+    """
+
+    global field_width, field_height, con, regions
+
+    # Caves come out about half floor, so this leaves the things about half
+    # of the open tiles
+    side = max(field_width, field_height, int(math.sqrt(count * 4)))
+    field_width = field_height = side
+    con = Canvas(side, side)
+    regions = (('con', 1, 1, con),) + regions[1:]
+
+    new_game(generator='caves')
+    # The player is there to watch, not to die
+    game.player.fighter.death_func = None
+
+    monster_dict = monster_table(game.dungeon_level, game.player.level)[1]
+    item_chances = item_table(game.dungeon_level)[1]
+    item_dict = item_templates()
+
+    shares = sum(stress_mix.values())
+    kinds = [kind for kind, share in stress_mix.items()
+             for _ in range(count * share // shares)]
+    free = np.argwhere(~game.field.blocked & ~blocking_map())
+    tiles = free[np.random.permutation(len(free))[:len(kinds)]].tolist()
+
+    placed = Counter()
+    for kind, (x, y) in zip(kinds, tiles):
+        if kind == 'item':
+            add_item(item_dict[randomizer(item_chances)], x, y)
+        elif kind == 'ally':
+            make_ally(add_monster(monster_dict['kobold'], x, y))
+        else:
+            add_monster(monster_dict[kind], x, y)
+        placed[kind] += 1
+    return placed
+
+
+def stress_test(count, turns):
+    """Plays `turns` turns on a floor with `count` things, the player walking
+    about at random, and prints how long they took
+    Returns True if 95% of turns fit in stress_budget_ms
+    """
+
+    global is_blocked, blocking_map
 
-    # DEF
-    render_stat(1, 9, 'DEF',
-                player.fighter.base_defense, player.fighter.defense)
+    placed = stress_floor(count)
+    print(f'{sum(placed.values())} things on a {field_width}x{field_height}'
+          f' floor: ' + ', '.join(f'{number} {kind}'
+                                  for kind, number in placed.items()))
 
-    # REG
-    render_stat(1, 11, 'REG',
-                player.fighter.base_regen, player.fighter.regen)
+    blocking = [Stopwatch(is_blocked), Stopwatch(blocking_map)]
+    is_blocked, blocking_map = blocking
+
+    def blocking_time():
+        return sum(watch.elapsed for watch in blocking)
+
+    times = {'ai' : [], 'blocking' : [], 'render' : [], 'total' : []}
+    awake = 0
+    try:
+        render_all()
+        for _ in range(turns):
+            start = time.perf_counter()
+            start_blocking = blocking_time()
+            player_move(*((0, -1), (0, 1), (-1, 0), (1, 0))[randint(0, 3)])
+            end_turn()
+            turn_end = time.perf_counter()
+            turn_blocking = blocking_time() - start_blocking
+
+            render_all()
+            end = time.perf_counter()
+            render_blocking = blocking_time() - start_blocking - turn_blocking
+
+            times['ai'].append(turn_end - start - turn_blocking)
+            times['blocking'].append(turn_blocking + render_blocking)
+            times['render'].append(end - turn_end - render_blocking)
+            times['total'].append(end - start)
+            awake += len(game.scheduler.heap)
+    finally:
+        is_blocked, blocking_map = (watch.func for watch in blocking)
+        game.close()
+
+    print(f'{turns} turns, {awake / turns:.0f} actors awake on average')
+    print(f'{"ms per turn":12}{"mean":>8}{"p95":>8}{"max":>8}')
+    for part, samples in times.items():
+        samples = np.array(samples) * 1000
+        print(f'{part:12}{samples.mean():8.2f}'
+              f'{np.percentile(samples, 95):8.2f}{samples.max():8.2f}')
+
+    p95 = np.percentile(times['total'], 95) * 1000
+    within = p95 <= stress_budget_ms
+    print(f'95% of turns took up to {p95:.1f} ms, the budget is '
+          f'{stress_budget_ms} ms: {"within" if within else "OVER"}')
+    return within
+
+
+def init_display():
+    """Opens the game window"""
+
+    global root, background
+
+    tdl.setFPS(fps_limit)
+    tdl.set_font('arial12x12.png', greyscale=True, altLayout=True)
+
+    # Initialize the main display
+    root = tdl.init(screen_width, screen_height,
+                    title="giraffelike", fullscreen=False)
+
+    # & bg
+    background = tdl.Console(screen_width, screen_height)
+    background.draw_rect(0, 0, screen_width, screen_height, ' ',
+                         bg=colors.darker_gray)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A roguelike in a warehouse')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='host games for telnet on this local port '
+                             'instead of opening a window')
+    parser.add_argument('--spectate', type=int, metavar='PORT',
+                        help='stream the game to watchers on this local port')
+    parser.add_argument('--stress', type=int, metavar='COUNT',
+                        help='time turns on a floor holding COUNT actors and '
+                             'items, without opening a window')
+    parser.add_argument('--turns', type=int, default=stress_turns,
+                        help='turns to time with --stress (default: '
+                             '%(default)s)')
+    args = parser.parse_args()
+
+    try:
+        if args.serve is not None:
+            serve(args.serve)
+            return
 
-    # Player Level & XP
-    render_bar(1, panel_height - 2, bar_width, f'Lv{player.level}',
-               int(player.fighter.xp),
-               level_up_base + player.level * level_up_factor,
-               colors.light_violet, colors.desaturated_violet, colors.white)
+        if args.stress is not None:
+            sys.exit(0 if stress_test(args.stress, args.turns) else 1)
 
-    # Blit the newly rendered bars to `root`
-    root.blit(panel, panel_x, panel_y, screen_width, panel_height, 0, 0)
+        init_display()
+        new_game()
+        game.renderers.append(TdlRenderer())
+        if args.spectate is not None:
+            game.renderers.append(Spectators(args.spectate))
+
+        while not tdl.event.is_window_closed():
+            frame_start = time.perf_counter()
+            render_all()
+            tdl.flush()
+            render_time = time.perf_counter() - frame_start
+
+            if play_turn(render_time) == 'exit':
+                break
+
+        game.close()
+    finally:
+        stop_planning()
 
 
 # FPS
 # irrelevant in turn-based, but not harmful
 fps_limit = 20
-tdl.setFPS(fps_limit)
 
 # Screen size
 screen_width = 100
@@ -1785,107 +4499,152 @@ screen_height = 60
 field_width = 60
 field_height = screen_height - 2
 
+# # Floor generation settings
+# The largest height or width of a room
+room_max = 13
+# The smallest h or w
+room_min = 5
+# Maximum number of rooms a map may generate
+room_num = 50
+# Caves: chance of a tile starting as wall, automaton passes,
+# and the size of the blocks that are treated as rooms
+cave_fill = 0.45
+cave_steps = 4
+cave_cell = 10
+# Walkable regions smaller than this are filled in rather than tunnelled to
+region_min = 4
+# Random guesses at a free tile before falling back to a full scan
+free_tile_tries = 20
+
+# Ticks a speed 100 actor waits between turns
+action_cost = 100
+# Dormant monsters this close to a fight wake up
+noise_radius = 4
+# Visited floors kept in memory, the rest are compressed onto disk
+floor_cache_size = 4
+# Threads planning monster turns, and the fewest actors due on one tick
+# worth handing to them. Plans mostly read shared flows in pure Python held
+# up by the GIL, so more than one thread does not pay yet
+ai_workers = 1
+ai_parallel_min = 64
+# Made by plan_turns() the first time it is needed, see stop_planning()
+planning_pool = None
+
 # # HUD settings
 panel_width = screen_width - field_width - 3
 # Messages
 msg_height = int(screen_height * 0.59)
-game_msgs = []
 # Stats
 bar_width = 20
+# Shades used for the partly filled cell at the end of a bar
+bar_shades = 8
 panel_height = screen_height - msg_height - 3
+# Where each HUD widget is on the panel, as (x, y, width)
+hud_layout = {
+    'hp' : (1, 1, bar_width),
+    'mp' : (1, 3, bar_width),
+    'str' : (1, 5, bar_width),
+    'mag' : (1, 7, bar_width),
+    'def' : (1, 9, bar_width),
+    'reg' : (1, 11, bar_width),
+    'xp' : (1, panel_height - 2, bar_width),
+    'floor' : (panel_width - 11, panel_height - 2, 11)
+}
+# The minimap's box on the panel, as (x, y) and size, and the fewest tiles
+# across that each of its cells stands for
+minimap_x = bar_width + 2
+minimap_y = 1
+minimap_width = panel_width - minimap_x
+minimap_height = panel_height - 4
+minimap_block = 4
 panel_x = field_width + 2
 panel_y = msg_height + 2
 # Menus
 inventory_width = 40
 level_up_width = 20
 spell_width = 30
+# How many drawn menus are kept around for reuse
+menu_cache_size = 16
 
-# # Tile colors
-# Unlit tiles
-c_dark_wall = (0, 0, 100)
-c_dark_gnd = (50, 50, 150)
-# Lit tiles
-c_light_wall = (130, 110, 50)
-c_light_gnd = (200, 180, 50)
-
-# Set the font
-tdl.set_font('arial12x12.png', greyscale=True, altLayout=True)
+# Sessions: home the cursor and clear the screen before a frame, and the
+# telnet options asking for keys as they are typed
+clear_screen = '\x1b[H\x1b[2J'
+telnet_char_mode = b'\xff\xfb\x01\xff\xfb\x03'
 
-# tdl FOV settings
-fov_algo = 'SHADOW'
+# FOV settings, see tcod.map.compute_fov()
+fov_algo = tcod.constants.FOV_SHADOW
 fov_light_walls = True
 fov_radius = 10
-
-# Initialize the main display
-root = tdl.init(screen_width, screen_height,
-                title="giraffelike", fullscreen=False)
-
-# & Game field
-con = tdl.Console(field_width, field_height)
-
-# & Message Box
-messages = tdl.Console(panel_width, msg_height)
-
-# & Stats panel
-panel = tdl.Console(panel_width, panel_height)
-
-# & bg
-background = tdl.Console(screen_width, screen_height)
-background.draw_rect(0, 0, screen_width, screen_height, ' ',
-                     bg=colors.darker_gray)
-
-# Create the player object
-fighter_mod = Fighter(hp=50, defense=1, power=5, xp=0,
-                      mp=15, mag=5, regen=1, death_func=player_death)
-player = Entity(
-    0, 0, '@', 'player', colors.white, blocks=True,
-    fighter=fighter_mod)
+# Tiles across the clusters of a floor's PathGraph, and how many clusters
+# away a target has to be before it is searched for over the portals. Closer
+# than that a search over every tile is quicker.
+path_cluster = 16
+path_portal_range = 8
+# Goals whose flow() a PathGraph keeps at once
+path_flows = 4
+# Tiles per floor whose view and glow are remembered, see sight_window()
+sight_cache_size = 256
+# Chance in 100 of a room having a torch, and how far torches light
+torch_chance = 30
+torch_radius = 5
+# How far the flash of a spell lights, and for how many turns
+spell_light = 4
+spell_light_turns = 2
+
+# How wide area spell cones fan out, as the tangent of half their angle
+cone_spread = 0.5
+
+# The tdl window, made by init_display()
+root = background = None
+
+# Canvases render_all() draws on, with where they go on the screen
+con = Canvas(field_width, field_height)
+messages = Canvas(panel_width, msg_height)
+panel = Canvas(panel_width, panel_height)
+regions = (('con', 1, 1, con),
+           ('messages', field_width + 2, 1, messages),
+           ('panel', panel_x, panel_y, panel))
+# The game whose frame is on the canvases
+canvas_owner = None
+# Bytes a spectator may fall behind by before it is dropped
+spectator_backlog = 1 << 20
+
+# & Menus
+# Free off-screen consoles by (width, height), and the menus last drawn
+console_pool = {}
+menu_cache = OrderedDict()
 
 # Player settings
-equipment = []
-inventory = []
-player.spells = []
 level_up_base = 200
 level_up_factor = 150
 level_screen_width = 40
+# Most turns one travel command takes before handing back control
+travel_limit = 500
+# Turns of rest per calm moment's worth of healing, see player_regen()
+rest_interval = 50
 # mouse_coord = (0, 0)
-player_action = None
-player.level = 1
-
-# initialize the field
-dungeon_level = 1
-fov_recompute = True
-stairs = Entity(1, 1, '>', 'stairs', colors.white,
-                always_visible=True)
-objects = [player, stairs]
-make_field()
 
-# Welcome message
-message('Welcome to the Warehouse, nerd.', colors.red)
-
-game_state = 'play'
-
-astar = new_astar_map()
-
-while not tdl.event.is_window_closed():
-    render_all()
-    tdl.flush()
-
-    check_level_up()
-
-    for thing in objects:
-        thing.clear()
-
-    player_action = handle_keys()
-
-    # Quit on esc
-    if player_action == 'exit':
-        break
-
-    # # Actions which only happen after the player acts
-    # Monsters' turn
-    if game_state == 'play' and player_action != 'no-turn':
-        player_regen()
-        for thing in objects:
-            if thing.ai:
-                thing.ai.take_turn()
+# Set to a file name to log how long turns and frames take
+telemetry_path = None
+telemetry_batch = 50
+# Set to a file name to write every game event to it
+replay_path = None
+
+# Stress test: the share of each kind of thing on the floor, how many turns
+# to time, and how long 95% of turns may take
+stress_mix = {
+    'kobold' : 60,
+    'orc' : 20,
+    'troll' : 5,
+    'ally' : 5,
+    'item' : 10
+}
+stress_turns = 100
+stress_budget_ms = 50
+
+# The game being played, and the lock sessions take turns holding
+game = None
+game_lock = threading.Lock()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+import giraffelike
+
+
+def walk_route(paths, start, goal, limit):
+    """Follows first_step() from start until it reaches goal
+    Returns the number of moves, or None if it gave up or got stuck
+    """
+
+    x, y = start
+    walkable = ~paths.fld.blocked
+    for moves in range(limit):
+        if (x, y) == goal:
+            return moves
+        step = paths.first_step(x, y, *goal)
+        if step is None:
+            return None
+        x, y = x + step[0], y + step[1]
+        assert walkable[x, y]
+    return None
+
+
+@pytest.mark.parametrize('portal_range', [giraffelike.path_portal_range, 1])
+def test_first_step_agrees_with_distance_map(monkeypatch, portal_range):
+    # Not square, so a cost map indexed [y, x] can't pass for one indexed
+    # [x, y]
+    monkeypatch.setattr(giraffelike, 'path_portal_range', portal_range)
+    np.random.seed(5)
+    fld = giraffelike.generate_floor('caves', 120, 70)[0]
+    paths = fld.path_graph()
+    walkable = ~fld.blocked
+    free = np.argwhere(walkable)
+
+    for _ in range(40):
+        start, goal = map(tuple,
+                          free[np.random.randint(len(free), size=2)].tolist())
+        goals = np.zeros(walkable.shape, dtype=bool)
+        goals[goal] = True
+        steps = giraffelike.distance_map(walkable, goals)[start]
+        assert steps >= 0
+
+        moves = walk_route(paths, start, goal, 2 * steps + 4 * paths.size)
+        assert moves is not None, (start, goal)
+        assert moves <= steps or portal_range == 1
+
+
+def test_first_step_follows_wall_changes():
+    np.random.seed(6)
+    fld = giraffelike.generate_floor('caves', 90, 60)[0]
+    paths = fld.path_graph()
+    free = np.argwhere(~fld.blocked).tolist()
+    (x, y), (tx, ty) = free[0], free[-1]
+    assert paths.first_step(x, y, tx, ty) is not None
+
+    # Wall the goal in, then let it out again
+    ring = np.zeros(fld.blocked.shape, dtype=bool)
+    ring[tx - 1:tx + 2, ty - 1:ty + 2] = True
+    ring[tx, ty] = False
+    was_blocked = fld.blocked[ring]
+    fld.set_walls(ring, True)
+    assert paths.first_step(x, y, tx, ty) is None
+
+    fld.set_walls(ring, was_blocked)
+    assert walk_route(paths, (x, y), (tx, ty), fld.width * fld.height)
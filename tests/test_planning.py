@@ -0,0 +1,47 @@
+import random
+
+import numpy as np
+import pytest
+
+import giraffelike
+
+
+@pytest.fixture
+def stress_globals(monkeypatch):
+    # stress_floor() resizes the floor and its canvas, and new_game()
+    # replaces the game
+    for name in ('field_width', 'field_height', 'con', 'regions', 'game',
+                 'ai_workers', 'ai_parallel_min', 'planning_pool'):
+        monkeypatch.setattr(giraffelike, name, getattr(giraffelike, name))
+    yield
+    giraffelike.stop_planning()
+
+
+def play(workers, turns=15):
+    """Plays `turns` seeded turns on a stress floor, planning on `workers`
+    threads
+    Returns where every thing ended up and how it fared
+    """
+
+    giraffelike.stop_planning()
+    giraffelike.ai_workers = workers
+    giraffelike.ai_parallel_min = 1
+    random.seed(7)
+    np.random.seed(7)
+
+    giraffelike.stress_floor(2000)
+    giraffelike.render_all()
+    moves = ((0, -1), (0, 1), (-1, 0), (1, 0))
+    for _ in range(turns):
+        giraffelike.player_move(*moves[random.randint(0, 3)])
+        giraffelike.end_turn()
+        giraffelike.render_all()
+    return [(obj.name, obj.x, obj.y, obj.fighter.hp if obj.fighter else None)
+            for obj in giraffelike.game.objects]
+
+
+def test_pooled_planning_matches_serial(stress_globals):
+    serial = play(1)
+    pooled = play(4)
+    assert giraffelike.planning_pool is not None
+    assert pooled == serial